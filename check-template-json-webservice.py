@@ -22,155 +22,735 @@
 # This is only an example/template. This check is not useful unless it 
 # is customized for your environment and webservice. 
 #
+# Several endpoints can be checked at once with --endpoints or
+# --endpointfile. They are requested at the same time over kept-alive
+# connections, each limited by --connecttimeout and --readtimeout. The
+# first line of output gives the worst state and each endpoint gets a
+# line of its own after it.
+#
+# The time taken by each phase of the request (DNS lookup, TCP connect,
+# TLS handshake, time to first byte and body transfer) is reported as
+# perfdata in milliseconds. --phasethresholds sets warning and critical
+# levels for any of them, for example ttfb=200:500,connect=50:100.
+# A kept-alive connection that is reused has no DNS, connect or TLS time.
+#
+# The response is parsed as it is read and only the fields asked for
+# with --field are kept. Reading stops once all of them have been seen,
+# or at --maxbody bytes, so large responses don't use more memory or
+# time. Without --field the template parse_time_nanoseconds and size
+# fields are checked against --maxtime and --maxsize.
+#
+# With --hedge a second request is sent, to the same server or to
+# --hedgehost, when the first hasn't answered within the usual response
+# time. That delay is a percentile of the recent response times kept in
+# the --hedgestate file. The first answer is used and the other request
+# is dropped, so one stuck connection doesn't fail the check.
+#
 # Nagios dev guidelines
 # http://nagiosplug.sourceforge.net/developer-guidelines.html
 #
 #
 
 
+import os
 import sys
+import re
 import json
+import time
+import fcntl
+import tempfile
 import argparse
+import threading
+import Queue
+from collections import namedtuple
 #from datetime import datetime, time, timedelta
-import httplib, urllib, urllib2
-from urllib2 import Request, urlopen, URLError, HTTPError
-from pprint import pprint
 
 #Variables
 useragent = 'Nagios/3.2.3'
 apipath = '/?json={"key1":"value1","key2":"value2","key3":"value3"}' 
 
-#Parse command line arguments
-parser = argparse.ArgumentParser(description='This is a template Nagios check that verifies a \
-                                              webservice is functioning and parses the returned JSON data. \
-                                              JSON data can be checked for values and alerted on. \
-                                              Perfdata is also generated for JSON values.')
+#Result of a check. state is the Nagios exit code and message the status
+#line. perfdata is None when there is no perfdata and long_output holds
+#any lines that go after the first.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
+
+#The check runs in main() so it can also be imported and run in-process.
+#It returns a CheckResult. Bad arguments and a few fatal errors print a
+#message and exit instead.
+def main(argv=None):
+
+        #Parse command line arguments
+        parser = argparse.ArgumentParser(description='This is a template Nagios check that verifies a \
+                                                      webservice is functioning and parses the returned JSON data. \
+                                                      JSON data can be checked for values and alerted on. \
+                                                      Perfdata is also generated for JSON values.')
+
+        parser.add_argument('--host', dest='host', type=str, default='',
+                            help='Hostname or IP address of api server. For this template use validate.jsontest.com')
+
+        parser.add_argument('--endpoints', dest='endpoints', type=str, nargs='+', default=[],
+                            metavar='HOST[/PATH]',
+                            help='Check several endpoints at the same time instead of --host. Each one is \
+                                  a hostname with an optional path. Default path is the template api path.')
+
+        parser.add_argument('--endpointfile', dest='endpointfile', type=str, default='',
+                            help='File with one HOST[/PATH] endpoint per line to check at the same time (optional).')
+
+        parser.add_argument('--threads', dest='threads', type=int, default=16,
+                            help='Number of endpoints to check at once. Default is 16.')
+
+        parser.add_argument('--connecttimeout', dest='connecttimeout', type=float, default=5,
+                            help='Seconds to wait for a connection to an api server. Default is 5.')
+
+        parser.add_argument('--readtimeout', dest='readtimeout', type=float, default=10,
+                            help='Seconds to wait for an api server to send data. Default is 10.')
+
+        parser.add_argument('--phasethresholds', dest='phasethresholds', type=str, default='',
+                            help='Warning and critical milliseconds for request phases as \
+                                  PHASE=WARN:CRIT[,PHASE=WARN:CRIT...]. Phases are dns, connect, \
+                                  tls, ttfb and transfer (optional).')
+
+        parser.add_argument('--field', dest='fields', type=str, action='append', default=[],
+                            metavar='PATH[=WARN:CRIT]',
+                            help='JSON field to report and alert on instead of parse_time_nanoseconds \
+                                  and size. PATH is the dotted path of a number in the response with \
+                                  array positions as numbers, for example queues.0.depth. Can be \
+                                  given more than once.')
+
+        parser.add_argument('--maxbody', dest='maxbody', type=int, default=1048576,
+                            help='Most bytes of a response to read looking for fields. Default is 1048576.')
+
+        parser.add_argument('--hedge', action='store_true',
+                            help='Send a second request when the first is slower than usual and use \
+                                  whichever answers first. Hedged requests don\'t reuse connections.')
+
+        parser.add_argument('--hedgehost', dest='hedgehost', type=str, default='',
+                            help='Hostname of another api server to send the second request to with \
+                                  --hedge (optional). Default is the same server.')
 
-parser.add_argument('--host', dest='host', type=str, required=True, 
-                    help='Hostname or IP address of api server. For this template use validate.jsontest.com')
+        parser.add_argument('--hedgestate', dest='hedgestate', type=str, default='',
+                            help='File to keep recent response times in for --hedge (optional). \
+                                  Without it the delay is always --hedgedelay.')
 
-parser.add_argument('--maxsize', dest='maxsize', type=int, default=20,
-                    help='Maximum number for some JSON value. Default is is 20.')
+        parser.add_argument('--hedgepercentile', dest='hedgepercentile', type=float, default=95,
+                            help='Percentile of recent response times to wait for before sending \
+                                  the second request. Default is 95.')
 
-parser.add_argument('--maxtime', dest='maxtime', type=float, default=0.7,
-                    help='Maximum parse time in milliseconds. Default is is 0.7.')
+        parser.add_argument('--hedgedelay', dest='hedgedelay', type=float, default=500,
+                            help='Milliseconds to wait before sending the second request until \
+                                  there are enough response times in --hedgestate. Default is 500.')
 
-parser.add_argument('--debug', action='store_true',
-                    help='Enable debug output.')
+        parser.add_argument('--hedgesamples', dest='hedgesamples', type=int, default=100,
+                            help='Number of recent response times to keep for each endpoint. \
+                                  Default is 100.')
 
-parser.add_argument('--ssl', action='store_true',
-                     help='Enable https/ssl communication with api server')
+        parser.add_argument('--maxsize', dest='maxsize', type=int, default=20,
+                            help='Maximum number for some JSON value. Default is is 20.')
 
-args = parser.parse_args()
+        parser.add_argument('--maxtime', dest='maxtime', type=float, default=0.7,
+                            help='Maximum parse time in milliseconds. Default is is 0.7.')
 
+        parser.add_argument('--debug', action='store_true',
+                            help='Enable debug output.')
 
-#Assign variables from command line arguments
-host = args.host
-maxsize = args.maxsize
-maxtime = args.maxtime
+        parser.add_argument('--ssl', action='store_true',
+                             help='Enable https/ssl communication with api server')
 
+        args = parser.parse_args(argv)
+
+
+        #Assign variables from command line arguments
+        host = args.host
+        maxsize = args.maxsize
+        maxtime = args.maxtime
+
+        #Build the list of endpoints as [perfdata label, host, path]
+        endpointList = list(args.endpoints)
+        if args.endpointfile:
+                with open(args.endpointfile) as f:
+                        for line in f:
+                                line = line.split('#')[0].strip()
+                                if line:
+                                        endpointList.append(line)
+        endpoints = []
+        for endpoint in endpointList:
+                endpointhost, sep, path = endpoint.partition('/')
+                if sep:
+                        path = '/' + path
+                else:
+                        path = apipath
+                endpoints.append([re.sub(r'[^\w.:/-]', '_', endpoint), endpointhost, path])
+
+        if not host and not endpoints:
+                print 'ERROR: --host or --endpoints is required.'
+                exit(3)
+
+        #Request phases in the order they happen and their
+        #[warning, critical] levels in milliseconds
+        phases = ['dns', 'connect', 'tls', 'ttfb', 'transfer']
+        phasethresholds = {}
+        for threshold in args.phasethresholds.split(','):
+                if not threshold.strip():
+                        continue
+                try:
+                        phase, levels = threshold.split('=')
+                        warnlevel, critlevel = [float(level) for level in levels.split(':')]
+                except ValueError:
+                        print 'ERROR: Phase thresholds must be PHASE=WARN:CRIT not ' + threshold
+                        exit(3)
+                phase = phase.strip()
+                if phase not in phases:
+                        print 'ERROR: Unknown phase ' + phase + '. Phases are ' + ', '.join(phases) + '.'
+                        exit(3)
+                if critlevel <= warnlevel:
+                        print 'ERROR: Critical value must be larger than warning value for ' + phase + '.'
+                        exit(3)
+                phasethresholds[phase] = [warnlevel, critlevel]
+
+        #Compile the fields to look for in the response as [name, path,
+        #warning, critical]. The path is a tuple of object keys and array
+        #positions. The template fields are used when no --field is given.
+        fields = []
+        for spec in args.fields or ['parse_time_nanoseconds', 'size']:
+                name, sep, levels = spec.partition('=')
+                fieldpath = tuple([int(part) if part.isdigit() else part for part in name.split('.')])
+                warnlevel = None
+                critlevel = None
+                if levels:
+                        try:
+                                warnlevel, critlevel = [float(level) for level in levels.split(':')]
+                        except ValueError:
+                                print 'ERROR: Fields must be PATH[=WARN:CRIT] not ' + spec
+                                exit(3)
+                        if critlevel <= warnlevel:
+                                print 'ERROR: Critical value must be larger than warning value for ' + name + '.'
+                                exit(3)
+                fields.append([name, fieldpath, warnlevel, critlevel])
+        fieldpaths = set([field[1] for field in fields])
+        fielddepths = set([len(fieldpath) for fieldpath in fieldpaths])
+
+        if not 0 < args.hedgepercentile <= 100:
+                print 'ERROR: Hedge percentile must be more than 0 and at most 100.'
+                exit(3)
+
+        #The network modules are slow to import so they are only
+        #loaded once the arguments are known to be good.
+        import socket
+        import ssl
+        import httplib
+
+
+        if (args.debug):
+                print '########## START DEBUG OUTPUT ############'
+                print 'HOST: ' + host
+                print 'MAXSIZE: ' + str(maxsize)
+                print 'MAXTIME: ' + str(maxtime) + ' milliseconds'
+                if (args.ssl):
+                        print 'SSL: Encrypted communication enabled.'
+                else:
+                        print 'SSL: Encrypted communication NOT enabled.'
+
+
+        #Set custom User-Agent string
+        headers = { 'User-Agent' : useragent }
+
+        #Each thread keeps its connections to the api servers open
+        #and reuses them for later requests to the same server.
+        threadData = threading.local()
 
-if (args.debug):
-        print '########## START DEBUG OUTPUT ############'
-        print 'HOST: ' + host
-        print 'MAXSIZE: ' + str(maxsize)
-        print 'MAXTIME: ' + str(maxtime) + ' milliseconds'
         if (args.ssl):
-                print 'SSL: Encrypted communication enabled.'
+                sslcontext = ssl.create_default_context()
+
+        def getConnection(apihost):
+                if not hasattr(threadData, 'conns'):
+                        threadData.conns = {}
+                if apihost not in threadData.conns:
+                        #Turn on https if the --ssl arg is passed
+                        if (args.ssl):
+                                threadData.conns[apihost] = httplib.HTTPSConnection(apihost)
+                        else:
+                                threadData.conns[apihost] = httplib.HTTPConnection(apihost)
+                return threadData.conns[apihost]
+
+        #Open the socket for a connection one step at a time so each
+        #phase can be timed. Times are added to timings in seconds.
+        def openConnection(conn, timings):
+                start = time.time()
+                addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+                timings['dns'] = time.time() - start
+
+                start = time.time()
+                for family, socktype, proto, canonname, sockaddr in addresses:
+                        sock = socket.socket(family, socktype, proto)
+                        sock.settimeout(args.connecttimeout)
+                        try:
+                                sock.connect(sockaddr)
+                                break
+                        except socket.error:
+                                sock.close()
+                                if sockaddr == addresses[-1][4]:
+                                        raise
+                timings['connect'] = time.time() - start
+
+                if (args.ssl):
+                        start = time.time()
+                        sock = sslcontext.wrap_socket(sock, server_hostname=conn.host)
+                        timings['tls'] = time.time() - start
+                sock.settimeout(args.readtimeout)
+                conn.sock = sock
+
+        #Start of the next JSON token after any whitespace. The end of a
+        #string is found with str.find, which is much faster than a regular
+        #expression on long strings. Strings are only decoded when they are
+        #object keys or wanted values.
+        jsontoken = re.compile(r'[ \t\r\n]*(?:([{}\[\],:"])|(-?[0-9][0-9.eE+-]*|true|false|null))')
+        readsize = 65536
+
+        #Read a JSON response a piece at a time and return the values found
+        #at the wanted field paths and whether --maxbody was reached first.
+        #Only the path to the current value is kept, as a stack of
+        #[is array, key or position, expecting a key] frames.
+        def readFields(response):
+                found = {}
+                stack = []
+                buf = ''
+                pos = 0
+                bytesread = 0
+                eof = False
+                while len(found) < len(fieldpaths):
+                        match = jsontoken.match(buf, pos)
+                        end = None
+                        if match is not None:
+                                end = match.end()
+                                if match.group(1) == '"':
+                                        #Skip quotes escaped by an odd number of backslashes
+                                        end = buf.find('"', end)
+                                        while end != -1:
+                                                slash = end - 1
+                                                while buf[slash] == '\\':
+                                                        slash -= 1
+                                                if (end - slash) % 2:
+                                                        break
+                                                end = buf.find('"', end + 1)
+                                        if end == -1:
+                                                end = None
+                                        else:
+                                                end += 1
+                        if end is None or (end == len(buf) and not eof):
+                                #Need more data for a whole token
+                                if eof:
+                                        if buf[pos:].strip():
+                                                raise ValueError('Invalid JSON at byte ' + str(bytesread - len(buf) + pos))
+                                        break
+                                if bytesread >= args.maxbody:
+                                        return found, True
+                                #Read at least as much again as is waiting so a
+                                #long string isn't searched over and over
+                                chunk = response.read(min(max(readsize, len(buf) - pos), args.maxbody - bytesread))
+                                bytesread += len(chunk)
+                                eof = not chunk
+                                buf = buf[pos:] + chunk
+                                pos = 0
+                                continue
+                        punct, scalar = match.groups()
+                        string = None
+                        if punct == '"':
+                                string = buf[match.end() - 1:end]
+                                punct = None
+                        pos = end
+                        if punct == '{':
+                                stack.append([False, None, True])
+                        elif punct == '[':
+                                stack.append([True, 0, False])
+                        elif punct == '}' or punct == ']':
+                                stack.pop()
+                        elif punct == ',':
+                                if stack[-1][0]:
+                                        stack[-1][1] += 1
+                                else:
+                                        stack[-1][2] = True
+                        elif punct == ':':
+                                pass
+                        elif stack and stack[-1][2]:
+                                if '\\' in string:
+                                        stack[-1][1] = json.loads(string)
+                                else:
+                                        stack[-1][1] = string[1:-1]
+                                stack[-1][2] = False
+                        elif len(stack) in fielddepths:
+                                valuepath = tuple([frame[1] for frame in stack])
+                                if valuepath in fieldpaths:
+                                        found[valuepath] = json.loads(string or scalar)
+                return found, False
+
+        #GET a path from an api server and return the status, reason, the
+        #values of the wanted fields, whether the response was too large and
+        #the time in seconds taken by each phase of the request. The rest of
+        #a response isn't read once all fields are found, so that connection
+        #is closed rather than reused.
+        #A kept-alive connection the server has since closed is reopened once,
+        #but a server that timed out is not asked again.
+        def fetchUrl(apihost, path):
+                while True:
+                        conn = getConnection(apihost)
+                        reused = conn.sock is not None
+                        timings = dict.fromkeys(phases, 0.0)
+                        try:
+                                if not reused:
+                                        openConnection(conn, timings)
+                                start = time.time()
+                                conn.request('GET', path, headers=headers)
+                                response = conn.getresponse()
+                                timings['ttfb'] = time.time() - start
+                                start = time.time()
+                                try:
+                                        if response.status == 200:
+                                                values, toolarge = readFields(response)
+                                        else:
+                                                values, toolarge = {}, False
+                                finally:
+                                        if not response.isclosed():
+                                                conn.close()
+                                timings['transfer'] = time.time() - start
+                                return response.status, response.reason, values, toolarge, timings
+                        except (socket.error, httplib.HTTPException) as e:
+                                conn.close()
+                                if not reused or isinstance(e, socket.timeout):
+                                        raise
+
+        def loadJsonFile(fileName):
+                try:
+                        with open(fileName) as f:
+                                return json.load(f)
+                except (IOError, ValueError):
+                        return {}
+
+        #The state file can be shared with checks running at the same time in
+        #other processes or check_runner.py threads. It is locked while it is
+        #read, changed and written back so no run's changes are lost, and is
+        #written to a unique temp file and renamed into place.
+        def updateJsonFile(fileName, update):
+                with open(fileName + '.lock', 'a') as lockfile:
+                        fcntl.flock(lockfile, fcntl.LOCK_EX)
+                        data = loadJsonFile(fileName)
+                        update(data)
+                        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(fileName) or '.')
+                        try:
+                                with os.fdopen(fd, 'w') as f:
+                                        json.dump(data, f)
+                                os.rename(tmpfile, fileName)
+                        except Exception:
+                                os.unlink(tmpfile)
+                                raise
+
+        #Recent response times in milliseconds for each endpoint. The file is
+        #read once here and this run's response times are added to it at the
+        #end so threads share it.
+        latencyhistory = {}
+        newlatencies = {}
+        historylock = threading.Lock()
+        if args.hedge and args.hedgestate:
+                latencyhistory = loadJsonFile(args.hedgestate)
+        #Fewest response times to take a percentile of
+        minhedgesamples = 20
+
+        #Milliseconds to wait for the first request before hedging
+        def hedgeDelay(key):
+                with historylock:
+                        samples = sorted(latencyhistory.get(key, []))
+                if len(samples) < minhedgesamples:
+                        return args.hedgedelay
+                return samples[int(round((len(samples) - 1) * args.hedgepercentile / 100))]
+
+        def recordLatency(key, latency):
+                with historylock:
+                        samples = latencyhistory.setdefault(key, [])
+                        samples.append(round(latency * 1000, 3))
+                        del samples[:-args.hedgesamples]
+                        newlatencies.setdefault(key, []).append(samples[-1])
+
+        #Drop a request that lost the race. Shutting the socket down wakes
+        #the thread if it is blocked reading.
+        def cancelRequest(conn):
+                sock = conn.sock
+                if sock is not None:
+                        try:
+                                sock.shutdown(socket.SHUT_RDWR)
+                        except socket.error:
+                                pass
+                conn.close()
+
+        #Like fetchUrl but a second request is sent when the first hasn't
+        #answered within the hedge delay, or straight away if it fails. Each
+        #request runs in its own daemon thread with its own connection. The
+        #first to answer is returned and the other is cancelled. The error
+        #of the last request is raised if they both fail, and a timeout if
+        #neither answers within the connect and read timeouts of the last.
+        def fetchHedged(apihost, path):
+                key = apihost + path
+                answers = Queue.Queue()
+                conns = []
+
+                def sendRequest(requesthost):
+                        start = time.time()
+                        try:
+                                conns.append(getConnection(requesthost))
+                                answer = fetchUrl(requesthost, path)
+                        except Exception as e:
+                                answers.put([None, e])
+                        else:
+                                answers.put([answer, time.time() - start])
+
+                hosts = [apihost, args.hedgehost or apihost]
+                thread = threading.Thread(target=sendRequest, args=(hosts[0],))
+                thread.daemon = True
+                thread.start()
+                sent = 1
+                waiting = 1
+                delay = hedgeDelay(key) / 1000.0
+                deadline = time.time() + delay
+                while True:
+                        try:
+                                answer, result = answers.get(True, max(0, deadline - time.time()))
+                        except Queue.Empty:
+                                if sent == len(hosts):
+                                        for conn in conns:
+                                                cancelRequest(conn)
+                                        raise socket.timeout('no answer within %g seconds'
+                                                             % (args.connecttimeout + args.readtimeout))
+                                answer, result = None, None
+                        else:
+                                waiting -= 1
+                        if answer is not None:
+                                recordLatency(key, result)
+                                for conn in conns:
+                                        cancelRequest(conn)
+                                if (args.debug):
+                                        print 'HEDGE: ' + key + ' answered after ' + str(sent) + ' requests'
+                                return answer
+                        if sent < len(hosts):
+                                #The first request is slow or failed so send the second
+                                thread = threading.Thread(target=sendRequest, args=(hosts[sent],))
+                                thread.daemon = True
+                                thread.start()
+                                sent += 1
+                                waiting += 1
+                                deadline = time.time() + args.connecttimeout + args.readtimeout
+                        elif waiting == 0:
+                                raise result
+
+        #Worse of two exit codes. Unknown ranks between warning and critical.
+        severity = [0, 1, 3, 2]
+
+        def worstCode(code1, code2):
+                if severity[code2] > severity[code1]:
+                        return code2
+                return code1
+
+        #Compare the phase times of a request against their thresholds and
+        #return the exit code, status message and perfdata.
+        def phaseStatus(timings, perfprefix):
+                exitcode = 0
+                msg = ''
+                perfdatamsg = ''
+                for phase in phases:
+                        phasetime = timings[phase] * 1000
+                        levels = ';'
+                        if phase in phasethresholds:
+                                warnlevel, critlevel = phasethresholds[phase]
+                                levels = '%g;%g' % (warnlevel, critlevel)
+                                if phasetime >= critlevel:
+                                        exitcode = worstCode(exitcode, 2)
+                                        msg += ' ' + phase + '=%.1fms CRIT' % phasetime
+                                elif phasetime >= warnlevel:
+                                        exitcode = worstCode(exitcode, 1)
+                                        msg += ' ' + phase + '=%.1fms WARN' % phasetime
+                        perfdatamsg += perfprefix + phase + '_time=%.3fms;' % phasetime + levels + ';0; '
+                return exitcode, msg, perfdatamsg
+
+        #Compare the --field values against their levels and return the
+        #exit code, status message and perfdata.
+        def fieldStatus(values, perfprefix):
+                exitcode = 0
+                msg = ''
+                perfdatamsg = ''
+                for name, fieldpath, warnlevel, critlevel in fields:
+                        value = values[fieldpath]
+                        levels = ';'
+                        if critlevel is not None:
+                                levels = '%g;%g' % (warnlevel, critlevel)
+                                if value >= critlevel:
+                                        exitcode = worstCode(exitcode, 2)
+                                        msg += ' ' + name + '=' + str(value) + ' CRIT'
+                                elif value >= warnlevel:
+                                        exitcode = worstCode(exitcode, 1)
+                                        msg += ' ' + name + '=' + str(value) + ' WARN'
+                        perfdatamsg += perfprefix + name + '=' + str(value) + ';' + levels + ';; '
+                if exitcode == 0:
+                        msg = 'Fields within limits.' + msg
+                else:
+                        msg = 'Fields exceeded limits.' + msg
+                return exitcode, msg, perfdatamsg
+
+        #Check one endpoint and return its label, exit code, status message,
+        #perfdata and request time in seconds.
+        def checkEndpoint(endpoint):
+                label, apihost, path = endpoint
+                if label:
+                        perfprefix = label + '_'
+                else:
+                        perfprefix = ''
+                if (args.debug):
+                        print "URL: " + ['http', 'https'][args.ssl] + '://' + apihost + path
+
+                # Handle http error responses from server.
+                start = time.time()
+                try:
+                        if (args.hedge):
+                                status, reason, values, toolarge, timings = fetchHedged(apihost, path)
+                        else:
+                                status, reason, values, toolarge, timings = fetchUrl(apihost, path)
+                except (socket.error, httplib.HTTPException) as e:
+                        msg = 'We failed to reach a server.' + str(e) + ' host=' + apihost
+                        return [label, 2, msg, '', None]
+                except (ValueError, IndexError) as e:
+                        msg = 'Invalid JSON response. ' + str(e) + ' host=' + apihost
+                        return [label, 3, msg, '', time.time() - start]
+                elapsed = time.time() - start
+                phasecode, phasemsg, phaseperf = phaseStatus(timings, perfprefix)
+                if status != 200:
+                        msg = 'Server couldn\'t fulfill the request.'
+                        msg += ' http_error_code=' + str(status) + ' host=' + apihost
+                        return [label, 2, msg + phasemsg, phaseperf, elapsed]
+
+                if (args.debug):
+                        from pprint import pprint
+                        print 'START JSON FIELDS:'
+                        print '----------------------------------'
+                        pprint(values)
+                        print '----------------------------------'
+                        print 'END JSON FIELDS'
+
+                #Every field must be a number
+                for name, fieldpath, warnlevel, critlevel in fields:
+                        value = values.get(fieldpath)
+                        if fieldpath not in values and toolarge:
+                                msg = 'Response larger than ' + str(args.maxbody) + ' bytes before ' + name \
+                                      + ' was found. host=' + apihost
+                                return [label, 2, msg + phasemsg, phaseperf, elapsed]
+                        if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                                msg = 'Invalid JSON response. ' + name + ' is missing or not a number. host=' + apihost
+                                return [label, worstCode(3, phasecode), msg + phasemsg, phaseperf, elapsed]
+
+                if args.fields:
+                        exitcode, msg, perfdatamsg = fieldStatus(values, perfprefix)
+                        msg += ' host=' + apihost + phasemsg
+                        return [label, worstCode(exitcode, phasecode), msg, perfdatamsg + phaseperf, elapsed]
+
+                parse_time = float(float(values[('parse_time_nanoseconds',)])/1000000)
+                size = values[('size',)]
+                if (args.debug):
+                        print 'PARSE TIME: ' + str(parse_time) + ' Milliseconds'
+                        print 'SIZE: ' + str(size)
+                #Evaluate returned data for maximums
+                if (parse_time < maxtime) and (size < maxsize):
+                        exitcode = 0
+                        msg = 'Parse time and size within limits.'
+                elif (parse_time >= maxtime) and (size < maxsize):
+                        exitcode = 1
+                        msg = 'Maximum parse time exceeded.'
+                elif (parse_time < maxtime) and (size >= maxsize):
+                        exitcode = 1
+                        msg = 'Maximum size exceeded.'
+                elif (parse_time >= maxtime) and (size >= maxsize):
+                        exitcode = 1
+                        msg = 'Both parse time and size have exceeded maximum values.'
+                else:
+                        exitcode = 3
+                        msg = 'Status unknown.'
+
+                # Additional output for status message
+                msg += ' parse_time=' + str(parse_time) + 'ms'
+                msg += ' size=' + str(size)
+                msg += ' host=' + apihost
+                msg += phasemsg
+
+                perfdatamsg = perfprefix + 'size=' + str(size) + ';0;0 '
+                perfdatamsg += perfprefix + 'parse_time=' + str(parse_time) + 'ms;0;0 '
+                perfdatamsg += phaseperf
+                return [label, worstCode(exitcode, phasecode), msg, perfdatamsg, elapsed]
+
+
+        statusnames = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+        longoutput = ''
+
+        if not endpoints:
+                label, exitcode, msg, perfdatamsg, elapsed = checkEndpoint(['', host, apipath])
+        else:
+                #Check all endpoints at once. Each one is limited by the connect
+                #and read timeouts so a slow endpoint doesn't hold up the rest.
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(min(args.threads, len(endpoints)))
+                results = pool.map(checkEndpoint, endpoints)
+                pool.close()
+                pool.join()
+
+                #Report the worst state
+                exitcode = 0
+                badlist = []
+                perfdatamsg = ''
+                lines = []
+                for label, endpointcode, endpointmsg, endpointperf, elapsed in results:
+                        exitcode = worstCode(exitcode, endpointcode)
+                        if endpointcode != 0:
+                                badlist.append(label + ':' + statusnames[endpointcode])
+                        lines.append(label + ': ' + statusnames[endpointcode] + ': ' + endpointmsg)
+                        perfdatamsg += label + '_state=' + str(endpointcode) + ';1;2;0;3 '
+                        if elapsed is not None:
+                                perfdatamsg += label + '_time=%.6fs;;;0; ' % elapsed
+                        perfdatamsg += endpointperf
+                if badlist:
+                        msg = str(len(badlist)) + ' of ' + str(len(results)) + ' endpoints not OK. ( ' \
+                              + ' '.join(badlist) + ' )'
+                else:
+                        msg = 'All ' + str(len(results)) + ' endpoints OK.'
+                longoutput = '\n'.join(lines)
+
+        #Generate final output for Nagios message
+        if (exitcode == 0):
+                statusline = 'OK: ' + msg
+        elif (exitcode == 1):
+                statusline = 'WARNING: ' + msg
+        elif (exitcode == 2):
+                statusline = 'CRITICAL: ' + msg
         else:
-                print 'SSL: Encrypted communication NOT enabled.'
-
-
-#Turn on https URL if the --ssl arg is passed
-if (args.ssl):
-        url = 'https://' + host + apipath
-	if (args.debug):
-		print "URL: " + url
-else:
-        url = 'http://' + host + apipath
-	if (args.debug):
-		print "URL: " + url
-
-
-#Set custom User-Agent string
-headers = { 'User-Agent' : useragent }
-
-# Build request string 
-req = urllib2.Request(url, None, headers)
-
-
-# Handle http error responses from server.
-try:
-        response = urllib2.urlopen(req)
-except HTTPError as e:
-        errorcode = e.code
-        msg = 'Server couldn\'t fulfill the request.'
-        msg += ' http_error_code=' + str(errorcode) + ' host=' + host
-	perfdatamsg = ''
-        exitcode = 2
-except URLError as e:
-        errorreason = e.reason
-        msg = 'We failed to reach a server.' + str(errorreason) + ' host=' + host
-	perfdatamsg = ''
-        exitcode = 2
-else:
-        jsondata = response.read() #Read JSON data from web site
-        data = json.loads(jsondata) #Load JSON data into a dict
-	parse_time = float(float(data['parse_time_nanoseconds'])/1000000)
-	size = data['size']
-	if (args.debug):
-		print 'START JSON OUTPUT:'
-		print '----------------------------------'
-		pprint(data)
-		print '----------------------------------'
-		print 'END JSON OUTPUT'
-		print 'PARSE TIME: ' + str(parse_time) + ' Milliseconds'
-		print 'SIZE: ' + str(size)
-	#Evaluate returned data for maximums
-	if (parse_time < maxtime) and (size < maxsize):
-		exitcode = 0
-		msg = 'Parse time and size within limits.'
-	elif (parse_time >= maxtime) and (size < maxsize):
-		exitcode = 1
-		msg = 'Maximum parse time exceeded.'
-	elif (parse_time < maxtime) and (size >= maxsize):
-		exitcode = 1
-		msg = 'Maximum size exceeded.'
-	elif (parse_time >= maxtime) and (size >= maxsize):
-		exitcode = 1
-		msg = 'Both parse time and size have exceeded maximum values.'
-	else:
-		exitcode = 3
-		msg = 'Status unknown.'
-
-	# Additional output for status message
-	msg += ' parse_time=' + str(parse_time) + 'ms'
-	msg += ' size=' + str(size)
-	msg += ' host=' + host
-
-        perfdatamsg = 'size=' + str(size) + ';0;0 '
-        perfdatamsg += 'parse_time=' + str(parse_time) + 'ms;0;0 '
-
-#Generate final output for Nagios message
-if (exitcode == 0):
-        statusline = 'OK: ' + msg + '|' + perfdatamsg
-elif (exitcode == 1):
-        statusline = 'WARNING: ' + msg + '|' + perfdatamsg
-elif (exitcode == 2):
-        statusline = 'CRITICAL: ' + msg + '|' + perfdatamsg
-else:
-        statusline = 'UNKNOWN: ' + msg + '|' + perfdatamsg
-        exitcode = 3
-
-
-if (args.debug):
-        print '########## END DEBUG OUTPUT ##############'
-        print ' '
- 
- 
-#Print Nagios status message
-print statusline
-exit(exitcode)
+                statusline = 'UNKNOWN: ' + msg
+                exitcode = 3
+
+
+        if (args.debug):
+                print '########## END DEBUG OUTPUT ##############'
+                print ' '
+
+
+        if args.hedge and args.hedgestate:
+                def addLatencies(history):
+                        for key, latencies in newlatencies.items():
+                                samples = history.setdefault(key, [])
+                                samples.extend(latencies)
+                                del samples[:-args.hedgesamples]
+                updateJsonFile(args.hedgestate, addLatencies)
 
+        #Nagios status message
+        return CheckResult(exitcode, statusline, perfdatamsg, longoutput)
 
 
+if __name__ == '__main__':
+        result = main()
+        output = result.message
+        if result.perfdata is not None:
+                output += '|' + result.perfdata
+        if result.long_output:
+                output += '\n' + result.long_output
+        print output
+        exit(result.state)
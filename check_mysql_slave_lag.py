@@ -11,108 +11,505 @@
 #
 
 import sys
+import os
+import re
+import json
+import time
+import datetime
+import tempfile
 import argparse
-import MySQLdb
+from collections import namedtuple
 
 def printUsage():
     print
     print "Example:    ", sys.argv[0], "--user myusername --pass mypassword --warn 10 --crit 20"
     print
 
-#Parse command line arguments
-parser = argparse.ArgumentParser(description='This script is a Nagios check that \
-                                    monitors the number of seconds a mysql slave \
-                                    is lagging behind a master.') \
+#Result of a check. state is the Nagios exit code and message the status
+#line. perfdata is None when there is no perfdata and long_output holds
+#any lines that go after the first.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
 
-parser.add_argument('--user', dest='user', type=str, required=True,
-                        help='Mysql db user name that has can run the \
-                              command SHOW SLAVE STATUS.')
+#The check runs in main() so it can also be imported and run in-process.
+#It returns a CheckResult. Bad arguments and a few fatal errors print a
+#message and exit instead.
+def main(argv=None):
 
-parser.add_argument('--passwd', dest='passwd', type=str, default='',
-                        help='Mysql password.')
+    #Parse command line arguments
+    parser = argparse.ArgumentParser(description='This script is a Nagios check that \
+                                        monitors the number of seconds a mysql slave \
+                                        is lagging behind a master.') \
 
-parser.add_argument('--host', dest='host', type=str, default='localhost',
-                        help='Mysql server hostname.')
+    parser.add_argument('--user', dest='user', type=str, required=True,
+                            help='Mysql db user name that has can run the \
+                                  command SHOW SLAVE STATUS.')
 
-parser.add_argument('--warn', dest='warn', type=int, required=True,
-                        help='Warning level for lag in seconds.')
+    parser.add_argument('--passwd', dest='passwd', type=str, default='',
+                            help='Mysql password.')
 
-parser.add_argument('--crit', dest='crit', type=int, required=True,
-                        help='Critical level for lag in seconds.')
+    parser.add_argument('--host', dest='host', type=str, default='localhost',
+                            help='Mysql server hostname.')
 
-parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+    parser.add_argument('--hosts', dest='hosts', type=str, default='',
+                            help='Comma separated list of Mysql servers to check \
+                                  at the same time (optional). Overrides --host.')
 
-args = parser.parse_args()
+    parser.add_argument('--hostfile', dest='hostfile', type=str, default='',
+                            help='File with one Mysql server hostname per line to \
+                                  check at the same time (optional). Overrides --host.')
 
-# Assign command line args to variable names
-dbuser = args.user
-dbpass = args.passwd
-dbhost = args.host
-warn = args.warn
-crit = args.crit
+    parser.add_argument('--connecttimeout', dest='connecttimeout', type=int, default=10,
+                            help='Seconds to wait for each connection. Default is 10.')
 
-if crit <= warn:
-    print
-    print "ERROR: Critical value must be larger than warning value."
-    printUsage()
-    exit(2)
-
-
-statusMsg = ""
-msgLine = ""
-perfdataMsg = ""
-replicationfailed = False
-exitCode = 3
-
-
-#Make connection to the Mysql server
-db=MySQLdb.connect(host=dbhost,db="",user=dbuser,passwd=dbpass)
-c=db.cursor()
-
-
-#Execute slave status command and get the data
-c.execute("""SHOW SLAVE STATUS""")
-row = c.fetchone()
-if args.debug:
-    print row
-
-#Close the db connection
-c.close()
-
-#Extract the lag value. Should be position 32 in the list
-lag_seconds = row[32]
-
-# I didn't like the previous way of handling failed replication
-# because it skewed the stats. Now if repication fails we will
-# set the value to zero and flag replication as failed.
-if lag_seconds is None:
-    lag_seconds = 0
-    replicationfailed = True
-else:
-    lag_seconds = int(lag_seconds)
-
-# Set exit code based on amount of lag
-if lag_seconds < warn and not replicationfailed:
-    statusMsg = "OK - Replication Lag " + str(lag_seconds) + " seconds"
-    exitCode = 0
-elif lag_seconds >= warn and lag_seconds < crit and not replicationfailed:
-    statusMsg = "WARNING - Replication Lag " + str(lag_seconds) + " seconds"
-    exitCode = 1
-elif lag_seconds >= crit and not replicationfailed:
-    statusMsg = "CRITICAL - Replication Lag " + str(lag_seconds) + " seconds"
-    exitCode = 2
-elif replicationfailed:
-    statusMsg = "CRITICAL - Replication Failed"
-    exitCode = 2
-else:
-    statusMsg = "UNKNOWN - Replication Lag " + str(lag_seconds) + " seconds"
+    parser.add_argument('--querytimeout', dest='querytimeout', type=int, default=0,
+                            help='Seconds to wait for each query (optional). Needs \
+                                  mysqlclient, MySQL-python does not support query \
+                                  timeouts and ignores it. Default is 0 (no timeout).')
+
+    parser.add_argument('--threads', dest='threads', type=int, default=64,
+                            help='Number of servers to check in parallel with \
+                                  --hosts or --hostfile. Default is 64.')
+
+    parser.add_argument('--heartbeattable', dest='heartbeattable', type=str, default='',
+                            help='Measure lag from a pt-heartbeat style table, for \
+                                  example percona.heartbeat, instead of \
+                                  Seconds_Behind_Master (optional). Lag is reported \
+                                  in milliseconds.')
+
+    parser.add_argument('--serverid', dest='serverid', type=int, default=None,
+                            help='server_id of the master in the heartbeat table \
+                                  (optional). Default is the newest row.')
+
+    parser.add_argument('--heartbeatutc', action='store_true',
+                            help='Heartbeat timestamps are in UTC (pt-heartbeat --utc). \
+                                  Default is local time.')
+
+    parser.add_argument('--daemon', action='store_true',
+                            help='Run as a collector that keeps connections open, \
+                                  checks the servers every --interval seconds and \
+                                  writes the results to --resultfile.')
+
+    parser.add_argument('--resultfile', dest='resultfile', type=str, default='',
+                            help='Results file written by --daemon. Without --daemon \
+                                  the check reads its results from this file instead \
+                                  of connecting to the servers.')
+
+    parser.add_argument('--interval', dest='interval', type=float, default=10,
+                            help='Seconds between checks with --daemon. Default is 10.')
+
+    parser.add_argument('--maxbackoff', dest='maxbackoff', type=float, default=300,
+                            help='Longest wait in seconds between reconnect attempts \
+                                  to a failed server with --daemon. Default is 300.')
+
+    parser.add_argument('--maxresultage', dest='maxresultage', type=float, default=60,
+                            help='Results in --resultfile older than this many seconds \
+                                  are treated as errors. Default is 60.')
+
+    parser.add_argument('--warn', dest='warn', type=int, required=True,
+                            help='Warning level for lag in seconds.')
+
+    parser.add_argument('--crit', dest='crit', type=int, required=True,
+                            help='Critical level for lag in seconds.')
+
+    parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+    args = parser.parse_args(argv)
+
+    # Assign command line args to variable names
+    dbuser = args.user
+    dbpass = args.passwd
+    dbhost = args.host
+    dbhosts = [h.strip() for h in args.hosts.split(',') if h.strip()]
+    if args.hostfile:
+        with open(args.hostfile) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    dbhosts.append(line)
+    warn = args.warn
+    crit = args.crit
+
+    if crit <= warn:
+        print
+        print "ERROR: Critical value must be larger than warning value."
+        printUsage()
+        exit(2)
+
+    if args.daemon and not args.resultfile:
+        print
+        print "ERROR: --daemon needs a --resultfile to write to."
+        printUsage()
+        exit(2)
+
+    if args.heartbeattable and not re.match(r'^[A-Za-z0-9_$]+(\.[A-Za-z0-9_$]+)?$', args.heartbeattable):
+        print
+        print "ERROR: Heartbeat table must be a table name or database.table."
+        printUsage()
+        exit(2)
+
+
+    statusMsg = ""
+    msgLine = ""
+    perfdataMsg = ""
+    longOutput = ""
     exitCode = 3
 
-perfdataMsg = "lag_seconds=" + str(lag_seconds) + ";" + str(warn) + ";" + str(crit) + "; "
+    # Timeouts for each connection and query
+    connectArgs = {'connect_timeout': args.connecttimeout}
+    if args.querytimeout > 0:
+        connectArgs['read_timeout'] = args.querytimeout
+
+
+    # Open a connection to a Mysql server. In daemon mode connections are
+    # kept open between checks and only reopened when a ping fails.
+    # MySQLdb is imported here so reading a results file doesn't load it.
+    connections = {}
+
+    def openConnection(host):
+        if args.daemon and host in connections:
+            try:
+                connections[host].ping()
+                return connections[host]
+            except Exception:
+                dropConnection(host)
+        import MySQLdb
+        try:
+            db=MySQLdb.connect(host=host,db="",user=dbuser,passwd=dbpass,**connectArgs)
+        except TypeError:
+            # MySQL-python doesn't know read_timeout so connect without it
+            if 'read_timeout' not in connectArgs:
+                raise
+            if args.debug:
+                print 'This MySQLdb does not support --querytimeout, ignoring it'
+            connectArgs.pop('read_timeout', None)
+            db=MySQLdb.connect(host=host,db="",user=dbuser,passwd=dbpass,**connectArgs)
+        if args.daemon:
+            connections[host] = db
+        return db
+
+    def closeConnection(db):
+        if not args.daemon:
+            db.close()
+
+    def dropConnection(host):
+        db = connections.pop(host, None)
+        if db is not None:
+            try:
+                db.close()
+            except Exception:
+                pass
+
+
+    # Column positions in SHOW SLAVE STATUS change between MySQL and
+    # MariaDB versions, so columns are looked up by name. The name to
+    # position map is built once for each server version.
+    columnMaps = {}
+
+    def getColumnMap(version, cursor):
+        if version not in columnMaps:
+            columnMaps[version] = dict((column[0], index)
+                                       for index, column in enumerate(cursor.description))
+        return columnMaps[version]
+
+
+    # Connect to a Mysql server and return the replication status of each
+    # channel. MySQL returns a row per channel from SHOW SLAVE STATUS but
+    # MariaDB needs SHOW ALL SLAVES STATUS to show every connection.
+    def getSlaveStatus(host):
+        #Make connection to the Mysql server
+        db=openConnection(host)
+        version = db.get_server_info()
+        c=db.cursor()
+
+        #Execute slave status command and get the data
+        if 'MariaDB' in version:
+            c.execute("""SHOW ALL SLAVES STATUS""")
+        else:
+            c.execute("""SHOW SLAVE STATUS""")
+        rows = c.fetchall()
+        if args.debug:
+            print host + ' (' + version + '): ' + str(rows)
+
+        channels = []
+        if rows:
+            columns = getColumnMap(version, c)
+            for row in rows:
+                def column(name):
+                    if name in columns:
+                        return row[columns[name]]
+                    return None
+                channels.append({'channel': column('Channel_Name') or column('Connection_name') or '',
+                                 'lag': column('Seconds_Behind_Master'),
+                                 'io': column('Slave_IO_Running'),
+                                 'sql': column('Slave_SQL_Running'),
+                                 'relay_log_pos': column('Relay_Log_Pos')})
+
+        #Close the db connection
+        c.close()
+        closeConnection(db)
+
+        return channels
+
+
+    # Read the newest pt-heartbeat timestamp and work out the lag against
+    # the local clock. The ts column looks like 2017-01-07T12:34:56.123456.
+    # Returns a single channel like getSlaveStatus so the output is the same.
+    def getHeartbeat(host):
+        db=openConnection(host)
+        c=db.cursor()
+        table = '.'.join('`' + part + '`' for part in args.heartbeattable.split('.'))
+        if args.serverid is not None:
+            c.execute("SELECT ts FROM " + table + " WHERE server_id = %s ORDER BY ts DESC LIMIT 1",
+                      (args.serverid,))
+        else:
+            c.execute("SELECT ts FROM " + table + " ORDER BY ts DESC LIMIT 1")
+        row = c.fetchone()
+        if args.debug:
+            print host + ': ' + str(row)
+        c.close()
+        closeConnection(db)
+
+        lag = None
+        if row is not None and row[0]:
+            ts = str(row[0]).replace(' ', 'T')
+            if '.' not in ts:
+                ts += '.0'
+            heartbeat = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%f')
+            if args.heartbeatutc:
+                now = datetime.datetime.utcnow()
+            else:
+                now = datetime.datetime.now()
+            delta = now - heartbeat
+            lag = max(0.0, delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0)
+        return [{'channel': '', 'lag': lag, 'io': None, 'sql': None,
+                 'relay_log_pos': None}]
+
+
+    # Check one server when checking many at once. Any error is returned
+    # instead of raised so one bad server can't stop the others.
+    def checkHost(host):
+        try:
+            return [host, getLag(host), None]
+        except Exception as e:
+            return [host, None, str(e)]
+
+
+    # Heartbeat lag is measured to the millisecond
+    getLag = getSlaveStatus
+    if args.heartbeattable:
+        getLag = getHeartbeat
+
+
+    # Decide the exit code and status text for a lag value
+    def lagStatus(lag_seconds):
+        # I didn't like the previous way of handling failed replication
+        # because it skewed the stats. Now if repication fails we will
+        # set the value to zero and flag replication as failed.
+        replicationfailed = False
+        if lag_seconds is None:
+            lag_seconds = 0
+            replicationfailed = True
+        elif not args.heartbeattable:
+            lag_seconds = int(lag_seconds)
+
+        # Set exit code based on amount of lag
+        if lag_seconds < warn and not replicationfailed:
+            return 0, "OK", lag_seconds
+        elif lag_seconds >= warn and lag_seconds < crit and not replicationfailed:
+            return 1, "WARNING", lag_seconds
+        elif lag_seconds >= crit and not replicationfailed:
+            return 2, "CRITICAL", lag_seconds
+        elif replicationfailed:
+            return 2, "FAILED", lag_seconds
+        else:
+            return 3, "UNKNOWN", lag_seconds
+
+
+    # Lag for the status line and perfdata. Heartbeat lag is shown to
+    # the millisecond and graphed in milliseconds.
+    def lagText(lag_seconds):
+        if args.heartbeattable:
+            return "%.3f" % lag_seconds
+        return str(lag_seconds)
+
+    def lagPerfdata(label, lag_seconds):
+        if args.heartbeattable:
+            return perfLabel(label, "lag_ms") + "=" + str(int(round(lag_seconds * 1000))) + "ms;" \
+                   + str(warn * 1000) + ";" + str(crit * 1000) + "; "
+        return perfLabel(label, "lag_seconds") + "=" + str(lag_seconds) + ";" \
+               + str(warn) + ";" + str(crit) + "; "
+
+
+    # Collector for --daemon. Every --interval seconds the servers are
+    # checked over the kept open connections and the results are written to
+    # --resultfile for the check to read. A server that fails is retried
+    # after a wait that doubles each time up to --maxbackoff.
+    # The results are written to a unique temp file and renamed into place
+    # so a check reading them never sees a partial write.
+    def writeResults(latest):
+        fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(args.resultfile) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(latest, f)
+            os.rename(tmpFile, args.resultfile)
+        except Exception:
+            os.unlink(tmpFile)
+            raise
+
+    def runCollector(hosts):
+        latest = {}
+        retryTime = dict((host, 0) for host in hosts)
+        retryDelay = dict((host, 0) for host in hosts)
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(args.threads, len(hosts)))
+        while True:
+            start = time.time()
+            dueHosts = [host for host in hosts if retryTime[host] <= start]
+            for host, channels, error in pool.map(checkHost, dueHosts):
+                if error is None:
+                    retryDelay[host] = 0
+                else:
+                    dropConnection(host)
+                    retryDelay[host] = min(max(1, retryDelay[host] * 2), args.maxbackoff)
+                    retryTime[host] = start + retryDelay[host]
+                    if args.debug:
+                        print host + ' ERROR: ' + error + ' (retry in ' + str(retryDelay[host]) + 's)'
+                latest[host] = {'channels': channels, 'error': error}
+            # Hosts waiting to be retried still have a current error
+            for host in hosts:
+                latest[host]['time'] = start
+            writeResults(latest)
+            time.sleep(max(0, args.interval - (time.time() - start)))
+
+    # Read the results for the servers from the collector's results file
+    def readResults(hosts):
+        try:
+            with open(args.resultfile) as f:
+                latest = json.load(f)
+        except (IOError, ValueError) as e:
+            print "UNKNOWN - Can't read results file " + args.resultfile + ": " + str(e)
+            exit(3)
+        hostResults = []
+        for host in hosts:
+            if host not in latest:
+                hostResults.append([host, None, 'No results from collector'])
+            elif time.time() - latest[host]['time'] > args.maxresultage:
+                hostResults.append([host, None, 'Results from collector are too old'])
+            else:
+                hostResults.append([host, latest[host]['channels'], latest[host]['error']])
+        return hostResults
+
+    if args.daemon:
+        runCollector(dbhosts or [dbhost])
+
+    # Get the channels for every server. Each result is a label (the host
+    # and/or channel name), the channel status and any error.
+    results = []
+    hostResults = []
+    if args.resultfile:
+        hostResults = readResults(dbhosts or [dbhost])
+    elif not dbhosts:
+        for channel in getLag(dbhost):
+            results.append([channel['channel'], channel, None])
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(args.threads, len(dbhosts)))
+        hostResults = pool.map(checkHost, dbhosts)
+        pool.close()
+        pool.join()
+
+    # A single server read from the results file is shown the same way as
+    # when it is checked directly.
+    if args.resultfile and not dbhosts:
+        host, channels, error = hostResults[0]
+        if error is not None:
+            return CheckResult(2, "CRITICAL - " + error, None, '')
+        hostResults = []
+        for channel in channels:
+            results.append([channel['channel'], channel, None])
+
+    for host, channels, error in hostResults:
+        if error is not None:
+            results.append([host, None, error])
+        elif not channels:
+            results.append([host, None, 'Not configured as a slave'])
+        for channel in channels or []:
+            if channel['channel']:
+                results.append([host + '/' + channel['channel'], channel, None])
+            else:
+                results.append([host, channel, None])
+
+    # Thread states shown when replication has failed
+    def threadStates(channel):
+        if args.heartbeattable:
+            return "no heartbeat"
+        return "IO:" + str(channel['io']) + " SQL:" + str(channel['sql'])
+
+    # Perfdata label with the host and/or channel name in front
+    def perfLabel(label, name):
+        if label:
+            return label + "_" + name
+        return name
+
+    if not results:
+        statusMsg = "UNKNOWN - Not configured as a slave"
+        exitCode = 3
+    elif len(results) == 1 and results[0][0] == '':
+        # One server with only the default channel
+        channel = results[0][1]
+        exitCode, status, lag_seconds = lagStatus(channel['lag'])
+        if status == "FAILED":
+            statusMsg = "CRITICAL - Replication Failed (" + threadStates(channel) + ")"
+        else:
+            statusMsg = status + " - Replication Lag " + lagText(lag_seconds) + " seconds"
+
+        perfdataMsg = lagPerfdata('', lag_seconds)
+        if channel['relay_log_pos'] is not None:
+            perfdataMsg += "relay_log_pos=" + str(channel['relay_log_pos']) + ";;; "
+    else:
+        # Many servers or channels. Report each one and the worst state.
+        # Unknown ranks between warning and critical.
+        # Each server that can't be checked gets a line with the reason
+        # after the status line.
+        severity = [0, 1, 3, 2]
+        exitCode = 0
+        statusMsgList = []
+        errorLines = []
+        for label, channel, error in results:
+            if error is not None:
+                if args.debug:
+                    print label + ' ERROR: ' + error
+                hostExitCode = 2
+                statusMsgList.append(label + ":ERROR")
+                errorLines.append(label + ": ERROR - " + error)
+            else:
+                hostExitCode, status, lag_seconds = lagStatus(channel['lag'])
+                if status == "FAILED":
+                    statusMsgList.append(label + ":FAILED(" + threadStates(channel) + ")")
+                else:
+                    statusMsgList.append(label + ":" + lagText(lag_seconds) + "s")
+                perfdataMsg += lagPerfdata(label, lag_seconds)
+                if channel['relay_log_pos'] is not None:
+                    perfdataMsg += perfLabel(label, "relay_log_pos") + "=" \
+                                   + str(channel['relay_log_pos']) + ";;; "
+            if severity[hostExitCode] > severity[exitCode]:
+                exitCode = hostExitCode
+
+        statusMsg = ["OK", "WARNING", "CRITICAL", "UNKNOWN"][exitCode] + " - Replication Lag ( " \
+                    + " ".join(statusMsgList) + " ) [W:" + str(warn) + " C:" + str(crit) + "]"
+        longOutput = "\n".join(errorLines)
+
 
+    # Final output for Nagios
+    return CheckResult(exitCode, statusMsg, perfdataMsg, longOutput)
 
-# Print final output for Nagios
-print statusMsg + "|" + perfdataMsg
 
-# Exit with appropriate code
-exit(exitCode)
+if __name__ == '__main__':
+    result = main()
+    output = result.message
+    if result.perfdata is not None:
+        output += '|' + result.perfdata
+    if result.long_output:
+        output += '\n' + result.long_output
+    print output
+    exit(result.state)
@@ -14,126 +14,553 @@
 # is not present in the cluster. This check only needs to be run on one
 # node in the cluster.
 #
-# Requires the rabbitmqadmin command to be installed. Edit rabbitmqadminCmd
-# if the rabbitmqadmin command isn't in /usr/local/bin.
+# Memory, file descriptor, socket, Erlang process and disk use of each
+# running node is reported as perfdata. A node that has run out of any
+# of these, is below its disk free limit or sees a network partition is
+# critical. Lower warning/critical levels can be set as percentages.
+#
+# The node list is read from the management HTTP API. If that fails, or
+# --rabbitmqadmin is given, the rabbitmqadmin command is used instead.
+# Edit rabbitmqadminCmd if the rabbitmqadmin command isn't in /usr/local/bin.
+#
+# Several clusters can be checked at once with --cluster or --clusterfile.
+# Each cluster is a name and a list of its nodes, for example
+# prod=rmq1:15672,rmq2:15672. The clusters are queried at the same time
+# and the next node of a cluster is tried when one can't be reached.
+# The whole check finishes within --deadline seconds. The first line
+# shows the worst state and each cluster gets its own line after it.
 #
 
+import os
 import sys
 import re
 import argparse
 import json
-from pprint import pprint
-from subprocess import check_output
-from subprocess import check_call
+import time
+import signal
+import threading
+from collections import namedtuple
+
+rabbitmqadminCmd = '/usr/local/bin/rabbitmqadmin'
 
 def printUsage():
     print
     print "Example:    ", sys.argv[0], "--host somehost --port 15672 --minnodes 2"
+    print "Example:    ", sys.argv[0], "--cluster prod=rmq1:15672,rmq2:15672 --cluster stage=rmq3 --minnodes 2"
     print
 
-#Parse command line arguments
-parser = argparse.ArgumentParser(description='This script is a Nagios check that \
-                                    monitors nodes in a rabbitMQ cluster.')
+#Result of a check. state is the Nagios exit code and message the status
+#line. perfdata is None when there is no perfdata and long_output holds
+#any lines that go after the first.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
 
-parser.add_argument('--host', dest='host', type=str, required=True,
-                        help='Hostname of rabbitmq server.')
+#The check runs in main() so it can also be imported and run in-process.
+#It returns a CheckResult. Bad arguments and a few fatal errors print a
+#message and exit instead.
+def main(argv=None):
 
-parser.add_argument('--port', dest='port', type=int, required=True,
-                        help='Port number for rabbitmqadmin http management interface.')
+    #Parse command line arguments
+    parser = argparse.ArgumentParser(description='This script is a Nagios check that \
+                                        monitors nodes in a rabbitMQ cluster.')
 
-parser.add_argument('--minnodes', dest='minnodes', type=int, required=True,
-                        help='Minimum number of nodes required in the cluster.')
+    parser.add_argument('--host', dest='host', type=str, default='',
+                            help='Hostname of rabbitmq server.')
 
-parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+    parser.add_argument('--port', dest='port', type=int, default=None,
+                            help='Port number for rabbitmqadmin http management interface. \
+                                  Default for --cluster nodes without a port is 15672.')
 
-args = parser.parse_args()
+    parser.add_argument('--cluster', dest='clusters', type=str, action='append', default=[],
+                            help='Cluster to check in the form name=host[:port][,host[:port]...]. \
+                                  Can be given more than once. Overrides --host.')
 
-# Assign command line args to variable names
-hostName = args.host
-portNum = args.port
-minNodes = args.minnodes
+    parser.add_argument('--clusterfile', dest='clusterfile', type=str, default='',
+                            help='File with one cluster per line in the same form as \
+                                  --cluster (optional).')
 
+    parser.add_argument('--deadline', dest='deadline', type=float, default=None,
+                            help='Seconds to wait for all clusters with --cluster. Clusters \
+                                  without an answer by then are unknown. The time is \
+                                  shared between the nodes of each cluster. Default \
+                                  is --timeout.')
 
-rabbitmqadminCmd = '/usr/local/bin/rabbitmqadmin'
-responseData = []
-depthList = []
-statusMsgList = []
-statusMsg = ""
-msgLine = ""
-perfdataMsg = ""
-warnCount = 0
-critCount = 0
-exitCode = 3
-
-#Run rabbitmqctl command to dump list of queues
-output=check_output([rabbitmqadminCmd, "list", "nodes", "--format=raw_json", "--port="+str(portNum), "--host="+hostName ])
-if args.debug:
-    print '----------------OUTPUT------------------'
-    print str(output)
-    print '----------------------------------------'
-
-
-##########################################
-#Parse the JSON data and put it in a dict
-responseData = json.loads(output)
-
-
-###########################################
-# Find number of nodes and compare against
-# the minnodes value
-nodeCount = len(responseData)
-if args.debug:
-    print 'NUMBER OF NODES: '+str(nodeCount)
-if nodeCount < minNodes:
-    if args.debug:
-        print 'ERROR: only ' + str(nodeCount) + ' of ' + str(minNodes) + ' nodes found'
-    statusMsgList.append('[CRIT: ' + str(nodeCount) + ' of ' + str(minNodes) + ' Nodes found]')
-    critCount += 1 #Increment critCount to indicate error state
-else:
-    statusMsgList.append('[OK: ' + str(nodeCount) + ' of ' + str(minNodes) + ' Nodes found]')
-
-
-##################################################
-# Loop through the nodes in the responseData and
-# check the running state for each.
-for node in responseData:
-    if args.debug:
-        print node['name'] + ': ' + str(node['running']);
-    if not node['running']:
-        critCount += 1 #Increment critCount to indicate error state
-        #Add node status to output message list
-        statusMsgList.append('[NODE:' + node['name'] + ' STATUS:*NOT RUNNING*]')
-    else:
-        statusMsgList.append('[NODE:' + node['name'] + ' STATUS:running]')
-
-
-
-# Set exit code based on number of warnings and criticals
-if warnCount == 0 and critCount == 0:
-    statusMsgList.insert(0, "OK - RabbitMQ Cluster")
-    exitCode = 0
-elif warnCount > 0 and critCount == 0:
-    statusMsgList.insert(0, "WARNING - RabbitMQ Cluster")
-    exitCode = 1
-elif critCount > 0:
-    statusMsgList.insert(0, "CRITICAL - RabbitMQ Cluster")
-    exitCode = 2
-else:
-    statusMsgList.insert(0, "UNKNOWN - RabbitMQ Cluster")
+    parser.add_argument('--minnodes', dest='minnodes', type=int, required=True,
+                            help='Minimum number of nodes required in the cluster.')
+
+    parser.add_argument('--memwarn', dest='memwarn', type=float, default=0,
+                            help='Warning level for memory use as a percent of the \
+                                  node memory limit. Default is 0 (disabled).')
+
+    parser.add_argument('--memcrit', dest='memcrit', type=float, default=100,
+                            help='Critical level for memory use as a percent of the \
+                                  node memory limit. Default is 100.')
+
+    parser.add_argument('--fdwarn', dest='fdwarn', type=float, default=0,
+                            help='Warning level for file descriptors used as a percent \
+                                  of the total. Default is 0 (disabled).')
+
+    parser.add_argument('--fdcrit', dest='fdcrit', type=float, default=100,
+                            help='Critical level for file descriptors used as a percent \
+                                  of the total. Default is 100.')
+
+    parser.add_argument('--socketwarn', dest='socketwarn', type=float, default=0,
+                            help='Warning level for sockets used as a percent of the \
+                                  total. Default is 0 (disabled).')
+
+    parser.add_argument('--socketcrit', dest='socketcrit', type=float, default=100,
+                            help='Critical level for sockets used as a percent of the \
+                                  total. Default is 100.')
+
+    parser.add_argument('--procwarn', dest='procwarn', type=float, default=0,
+                            help='Warning level for Erlang processes used as a percent \
+                                  of the total. Default is 0 (disabled).')
+
+    parser.add_argument('--proccrit', dest='proccrit', type=float, default=100,
+                            help='Critical level for Erlang processes used as a percent \
+                                  of the total. Default is 100.')
+
+    parser.add_argument('--diskwarn', dest='diskwarn', type=float, default=0,
+                            help='Warn when free disk space is below this many times \
+                                  the node disk free limit. Default is 0 (disabled). \
+                                  Below the limit itself is always critical.')
+
+    parser.add_argument('--user', dest='user', type=str, default=None,
+                            help='User name for the management interface (optional). \
+                                  The HTTP API uses guest when it isn\'t given and \
+                                  rabbitmqadmin uses its own config file.')
+
+    parser.add_argument('--password', dest='password', type=str, default=None,
+                            help='Password for the management interface (optional). \
+                                  The HTTP API uses guest when it isn\'t given and \
+                                  rabbitmqadmin uses its own config file.')
+
+    parser.add_argument('--ssl', action='store_true',
+                            help='Use https to talk to the management interface.')
+
+    parser.add_argument('--cacert', dest='cacert', type=str, default=None,
+                            help='CA certificate file used to verify the server with --ssl.')
+
+    parser.add_argument('--insecure', action='store_true',
+                            help='Don\'t verify the server certificate with --ssl.')
+
+    parser.add_argument('--timeout', dest='timeout', type=float, default=10,
+                            help='Seconds to wait for each request to the management \
+                                  interface. Default is 10.')
+
+    parser.add_argument('--rabbitmqadmin', action='store_true',
+                            help='Always use the rabbitmqadmin command instead of \
+                                  the HTTP API.')
+
+    parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+    args = parser.parse_args(argv)
+
+    # Assign command line args to variable names
+    hostName = args.host
+    portNum = args.port
+    minNodes = args.minnodes
+    deadlineSecs = args.deadline
+    if deadlineSecs is None:
+        deadlineSecs = args.timeout
+
+    # Read the cluster list. Each cluster is [name, [[host, port], ...]]
+    clusterSpecs = list(args.clusters)
+    if args.clusterfile:
+        with open(args.clusterfile) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    clusterSpecs.append(line)
+    clusters = []
+    for spec in clusterSpecs:
+        name, sep, nodeList = spec.partition('=')
+        endpoints = []
+        for endpoint in nodeList.split(','):
+            endpoint = endpoint.strip()
+            if not endpoint:
+                continue
+            host, sep, port = endpoint.partition(':')
+            if port:
+                endpoints.append([host, int(port)])
+            else:
+                endpoints.append([host, portNum or 15672])
+        if not name or not endpoints:
+            print
+            print "ERROR: Cluster must be given as name=host[:port][,host[:port]...] not " + spec
+            printUsage()
+            exit(2)
+        clusters.append([name.strip(), endpoints])
+
+    if not clusters and (not hostName or portNum is None):
+        print
+        print "ERROR: --host and --port or --cluster are required."
+        printUsage()
+        exit(2)
+
+    # The network modules are slow to import so they are only
+    # loaded once the arguments are known to be good.
+    import socket
+    import ssl
+    import httplib
+    import base64
+
+    responseData = []
+    depthList = []
+    statusMsgList = []
+    statusMsg = ""
+    msgLine = ""
+    perfdataMsg = ""
+    warnCount = 0
+    critCount = 0
     exitCode = 3
 
-# Build status message output
-for msg in statusMsgList:
-    statusMsg += msg + " "
+    # Connections to the management interface are kept open and reused
+    # for further requests to the same server.
+    httpConnections = {}
+
+    def getHttpConnection(host, port, timeout):
+        if (host, port) not in httpConnections:
+            if args.ssl:
+                context = ssl.create_default_context(cafile=args.cacert)
+                if args.insecure:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                httpConnections[(host, port)] = httplib.HTTPSConnection(host, port, timeout=timeout,
+                                                                        context=context)
+            else:
+                httpConnections[(host, port)] = httplib.HTTPConnection(host, port, timeout=timeout)
+        conn = httpConnections[(host, port)]
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    # GET a path from the management HTTP API and return the response body
+    def apiGet(host, port, path, timeout):
+        conn = getHttpConnection(host, port, timeout)
+        credentials = (args.user or 'guest') + ':' + (args.password or 'guest')
+        headers = {'Authorization': 'Basic ' + base64.b64encode(credentials),
+                   'Accept': 'application/json',
+                   'Connection': 'keep-alive'}
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            httpConnections.pop((host, port), None)
+            raise
+        if response.status != 200:
+            raise httplib.HTTPException('HTTP ' + str(response.status) + ' ' + response.reason + ' for ' + path)
+        return body
+
+    #Run rabbitmqadmin command to dump list of nodes. It runs in its own
+    #process group which is killed if it hasn't finished within timeout
+    #seconds, so a wrapper script's children are killed too.
+    def rabbitmqadminNodes(host, port, timeout):
+        cmd = [rabbitmqadminCmd, "list", "nodes", "--format=raw_json", "--port="+str(port), "--host="+host]
+        # Credentials are only passed when given so the ones in
+        # ~/.rabbitmqadmin.conf still apply
+        if args.user is not None:
+            cmd.append("--username="+args.user)
+        if args.password is not None:
+            cmd.append("--password="+args.password)
+        if args.ssl:
+            cmd.append("--ssl")
+        from subprocess import Popen, PIPE, CalledProcessError
+        proc = Popen(cmd, stdout=PIPE, preexec_fn=os.setsid)
+        timedOut = []
+        def kill():
+            timedOut.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        killer = threading.Timer(timeout, kill)
+        killer.start()
+        try:
+            output = proc.communicate()[0]
+        finally:
+            killer.cancel()
+        if timedOut:
+            raise RuntimeError('rabbitmqadmin timed out after ' + str(timeout) + ' seconds')
+        if proc.returncode != 0:
+            raise CalledProcessError(proc.returncode, cmd, output)
+        return output
+
+    #Get the list of nodes from the HTTP API, falling back to rabbitmqadmin.
+    #A node that timed out isn't asked again with rabbitmqadmin as it would
+    #most likely hang the same way.
+    def getNodes(host, port, timeout):
+        httpError = None
+        if not args.rabbitmqadmin:
+            try:
+                return apiGet(host, port, '/api/nodes', timeout)
+            except (socket.error, httplib.HTTPException) as e:
+                if isinstance(e, socket.timeout):
+                    raise
+                if args.debug:
+                    print 'HTTP API request failed, using rabbitmqadmin: ' + str(e)
+                httpError = e
+        try:
+            return rabbitmqadminNodes(host, port, timeout)
+        except OSError:
+            # rabbitmqadmin isn't installed so report why the HTTP API failed
+            if httpError is not None:
+                raise httpError
+            raise
+
+    ##################################################
+    # Check the node list of one cluster. Returns the
+    # warning and critical counts, status messages and
+    # perfdata with labelPrefix in front of each label.
+    def checkNodes(responseData, labelPrefix):
+        statusMsgList = []
+        perfdataMsg = ""
+        warnCount = 0
+        critCount = 0
+
+        ###########################################
+        # Find number of nodes and compare against
+        # the minnodes value
+        nodeCount = len(responseData)
+        if args.debug:
+            print 'NUMBER OF NODES: '+str(nodeCount)
+        if nodeCount < minNodes:
+            if args.debug:
+                print 'ERROR: only ' + str(nodeCount) + ' of ' + str(minNodes) + ' nodes found'
+            statusMsgList.append('[CRIT: ' + str(nodeCount) + ' of ' + str(minNodes) + ' Nodes found]')
+            critCount += 1 #Increment critCount to indicate error state
+        else:
+            statusMsgList.append('[OK: ' + str(nodeCount) + ' of ' + str(minNodes) + ' Nodes found]')
+
+
+        ##################################################
+        # Loop through the nodes in the responseData and
+        # check the running state for each.
+        for node in responseData:
+            if args.debug:
+                print node['name'] + ': ' + str(node['running']);
+            if not node['running']:
+                critCount += 1 #Increment critCount to indicate error state
+                #Add node status to output message list
+                statusMsgList.append('[NODE:' + node['name'] + ' STATUS:*NOT RUNNING*]')
+            else:
+                statusMsgList.append('[NODE:' + node['name'] + ' STATUS:running]')
+
+
+        ##################################################
+        # Check resource use of the running nodes and
+        # build perfdata for each one. Each resource is
+        # the label, used and total fields, warning and
+        # critical percent levels and unit of measure.
+        resourceChecks = [['mem', 'mem_used', 'mem_limit', args.memwarn, args.memcrit, 'B'],
+                          ['fd', 'fd_used', 'fd_total', args.fdwarn, args.fdcrit, ''],
+                          ['sockets', 'sockets_used', 'sockets_total', args.socketwarn, args.socketcrit, ''],
+                          ['proc', 'proc_used', 'proc_total', args.procwarn, args.proccrit, '']]
+
+        for node in responseData:
+            if not node['running']:
+                continue
+            nodeLabel = labelPrefix + node['name']
+            for label, usedField, totalField, warnPct, critPct, uom in resourceChecks:
+                used = node.get(usedField)
+                total = node.get(totalField)
+                if used is None or not total:
+                    continue
+                usedPct = 100.0 * used / total
+                warnLevel = ''
+                critLevel = ''
+                if warnPct > 0:
+                    warnLevel = str(int(total * warnPct / 100))
+                if critPct > 0:
+                    critLevel = str(int(total * critPct / 100))
+                if critPct > 0 and usedPct >= critPct:
+                    critCount += 1
+                    statusMsgList.append('[NODE:' + node['name'] + ' ' + label.upper() + ':%.0f%% CRIT]' % usedPct)
+                elif warnPct > 0 and usedPct >= warnPct:
+                    warnCount += 1
+                    statusMsgList.append('[NODE:' + node['name'] + ' ' + label.upper() + ':%.0f%% WARN]' % usedPct)
+                perfdataMsg += nodeLabel + '_' + usedField + '=' + str(used) + uom + ';' + warnLevel + ';' \
+                               + critLevel + ';0;' + str(total) + ' '
+
+            # Free disk space alerts when it drops below the levels
+            diskFree = node.get('disk_free')
+            diskLimit = node.get('disk_free_limit')
+            if diskFree is not None and diskLimit is not None:
+                warnLevel = ''
+                if args.diskwarn > 0:
+                    warnLevel = str(int(diskLimit * args.diskwarn)) + ':'
+                if diskFree < diskLimit:
+                    critCount += 1
+                    statusMsgList.append('[NODE:' + node['name'] + ' DISK:below free limit CRIT]')
+                elif args.diskwarn > 0 and diskFree < diskLimit * args.diskwarn:
+                    warnCount += 1
+                    statusMsgList.append('[NODE:' + node['name'] + ' DISK:near free limit WARN]')
+                perfdataMsg += nodeLabel + '_disk_free=' + str(diskFree) + 'B;' + warnLevel + ';' \
+                               + str(diskLimit) + ':;0; '
+
+            # Any network partition seen by a node is critical
+            partitions = node.get('partitions', [])
+            if partitions:
+                critCount += 1
+                statusMsgList.append('[NODE:' + node['name'] + ' PARTITIONED FROM:' + ','.join(partitions) + ']')
+            perfdataMsg += nodeLabel + '_partitions=' + str(len(partitions)) + ';;0;0; '
+
+        return [warnCount, critCount, statusMsgList, perfdataMsg]
+
+
+    # Nagios state for warning and critical counts
+    def countsExitCode(warnCount, critCount):
+        if critCount > 0:
+            return 2
+        elif warnCount > 0:
+            return 1
+        return 0
+
+    stateNames = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
+    longOutput = ""
+
+    # Results of each cluster as [node asked, node list, error]
+    clusterResults = {}
+
+    ##################################################
+    # Get the node list of one cluster, trying the HTTP
+    # API of each of its nodes in turn until one answers
+    # or the deadline passes. Only when none of them
+    # answer is rabbitmqadmin tried, on the nodes that
+    # didn't time out. The time left is shared between
+    # the nodes still to try so a hung node can't use up
+    # the time the others need, and a little is kept
+    # back to hand the result over before the deadline.
+    def nodeTimeout(nodesLeft):
+        remaining = deadline - time.time() - 0.1
+        if remaining <= 0:
+            return None
+        return min(args.timeout, remaining / nodesLeft)
+
+    def queryCluster(name, endpoints):
+        errors = []
+        fallbackEndpoints = []
+        if args.rabbitmqadmin:
+            fallbackEndpoints = list(endpoints)
+            endpoints = []
+        for index, (host, port) in enumerate(endpoints):
+            timeout = nodeTimeout(len(endpoints) - index)
+            if timeout is None:
+                errors.append('out of time')
+                break
+            try:
+                output = apiGet(host, port, '/api/nodes', timeout)
+                clusterResults[name] = [host, json.loads(output), None]
+                return
+            except Exception as e:
+                if args.debug:
+                    print name + ': ' + host + ':' + str(port) + ' failed: ' + str(e)
+                errors.append(host + ':' + str(port) + ' ' + str(e))
+                if not isinstance(e, socket.timeout):
+                    fallbackEndpoints.append([host, port])
+        for index, (host, port) in enumerate(fallbackEndpoints):
+            timeout = nodeTimeout(len(fallbackEndpoints) - index)
+            if timeout is None:
+                errors.append('out of time')
+                break
+            try:
+                output = rabbitmqadminNodes(host, port, timeout)
+                clusterResults[name] = [host, json.loads(output), None]
+                return
+            except OSError as e:
+                # rabbitmqadmin isn't installed so only report the HTTP errors
+                if args.rabbitmqadmin:
+                    errors.append('rabbitmqadmin: ' + str(e))
+                break
+            except Exception as e:
+                if args.debug:
+                    print name + ': rabbitmqadmin ' + host + ':' + str(port) + ' failed: ' + str(e)
+                errors.append(host + ':' + str(port) + ' rabbitmqadmin ' + str(e))
+        clusterResults[name] = [None, None, ', '.join(errors)]
+
+
+    if not clusters:
+        try:
+            output = getNodes(hostName, portNum, args.timeout)
+        except Exception as e:
+            return CheckResult(3, "UNKNOWN - RabbitMQ Cluster [Can't get node list: " + str(e) + "]", '', '')
+        if args.debug:
+            print '----------------OUTPUT------------------'
+            print str(output)
+            print '----------------------------------------'
+
+
+        ##########################################
+        #Parse the JSON data and put it in a dict
+        responseData = json.loads(output)
+
+        warnCount, critCount, statusMsgList, perfdataMsg = checkNodes(responseData, '')
+
+        # Set exit code based on number of warnings and criticals
+        exitCode = countsExitCode(warnCount, critCount)
+        statusMsgList.insert(0, stateNames[exitCode] + " - RabbitMQ Cluster")
+
+        # Build status message output
+        for msg in statusMsgList:
+            statusMsg += msg + " "
+    else:
+        ##################################################
+        # Query every cluster at the same time. Clusters
+        # that haven't answered by the deadline are unknown.
+        # The query threads are daemon threads so a hung
+        # server doesn't stop the check from exiting.
+        deadline = time.time() + deadlineSecs
+        threads = []
+        for name, endpoints in clusters:
+            thread = threading.Thread(target=queryCluster, args=(name, endpoints))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        results = dict(clusterResults)
+
+        # Report each cluster on its own line and the worst
+        # state on the first. Unknown ranks between warning
+        # and critical.
+        severity = [0, 1, 3, 2]
+        exitCode = 0
+        clusterLines = []
+        for name, endpoints in clusters:
+            host, responseData, error = results.get(name, [None, None, 'No answer within ' + str(deadlineSecs) + ' seconds'])
+            if error is not None:
+                clusterExitCode = 3
+                clusterLines.append(name + ": UNKNOWN - [Can't get node list: " + error + "]")
+            else:
+                warnCount, critCount, clusterMsgList, clusterPerfdata = checkNodes(responseData, name + '_')
+                clusterExitCode = countsExitCode(warnCount, critCount)
+                clusterLines.append(name + ": " + stateNames[clusterExitCode] + " - (via " + host + ") " \
+                                    + " ".join(clusterMsgList))
+                perfdataMsg += clusterPerfdata
+            statusMsgList.append(name + ":" + stateNames[clusterExitCode])
+            if severity[clusterExitCode] > severity[exitCode]:
+                exitCode = clusterExitCode
+
+        statusMsg = stateNames[exitCode] + " - RabbitMQ Clusters ( " + " ".join(statusMsgList) + " ) "
+        longOutput = "\n".join(clusterLines)
 
 
-# Build perfdata output
-#for index in range(len(qList)):
-#    perfdataMsg += qList[index] + "=" + str(depthList[index]) + ";" + str(warnDepth) + ";" + str(critDepth) + "; "
+    # Final output for Nagios
+    return CheckResult(exitCode, statusMsg, perfdataMsg, longOutput)
 
 
-# Print final output for Nagios
-print statusMsg + "|" + perfdataMsg
+if __name__ == '__main__':
+    result = main()
+    output = result.message
+    if result.perfdata is not None:
+        output += '|' + result.perfdata
+    if result.long_output:
+        output += '\n' + result.long_output
+    print output
 
-# Exit with appropriate code
-exit(exitCode)
+    # Query threads still waiting on a hung server can't be stopped
+    # and raise errors when the interpreter shuts down under them.
+    sys.stdout.flush()
+    os._exit(result.state)
@@ -0,0 +1,356 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This Nagios check looks at the depth of queues on a RabbitMQ server
+# and alerts if the number of ready or unacknowledged messages in any
+# queue is too high. Publish and deliver rates are reported as perfdata.
+#
+# Queues are read from the management HTTP API a page at a time with
+# only the columns this check needs, and filtered by name on the server,
+# so brokers with many thousands of queues don't send megabytes of JSON.
+# Each page is parsed whole, so memory use is set by --pagesize rather
+# than by the number of queues. Requires RabbitMQ 3.6 or later for paging
+# and name filtering.
+#
+
+import sys
+import argparse
+import json
+from collections import namedtuple
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--host somehost --port 15672 --name '^orders\\.' --warn 1000 --crit 5000"
+    print
+
+#Result of a check. state is the Nagios exit code and message the status
+#line. perfdata is None when there is no perfdata and long_output holds
+#any lines that go after the first.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
+
+#The check runs in main() so it can also be imported and run in-process.
+#It returns a CheckResult. Bad arguments and a few fatal errors print a
+#message and exit instead.
+def main(argv=None):
+
+    #Parse command line arguments
+    parser = argparse.ArgumentParser(description='This script is a Nagios check that \
+                                        monitors the depth of queues on a rabbitMQ server.')
+
+    parser.add_argument('--host', dest='host', type=str, required=True,
+                            help='Hostname of rabbitmq server.')
+
+    parser.add_argument('--port', dest='port', type=int, required=True,
+                            help='Port number for the http management interface.')
+
+    parser.add_argument('--vhost', dest='vhost', type=str, default='',
+                            help='Only check queues in this vhost (optional).')
+
+    parser.add_argument('--name', dest='name', type=str, default='',
+                            help='Regular expression to match queue names (optional). \
+                                  Default is all queues.')
+
+    parser.add_argument('--warn', dest='warn', type=int, required=True,
+                            help='Warning level for ready messages in a queue.')
+
+    parser.add_argument('--crit', dest='crit', type=int, required=True,
+                            help='Critical level for ready messages in a queue.')
+
+    parser.add_argument('--warnunacked', dest='warnunacked', type=int, default=None,
+                            help='Warning level for unacknowledged messages in a queue (optional).')
+
+    parser.add_argument('--critunacked', dest='critunacked', type=int, default=None,
+                            help='Critical level for unacknowledged messages in a queue (optional).')
+
+    parser.add_argument('--warnpublish', dest='warnpublish', type=float, default=None,
+                            help='Warning level for the total publish rate in messages \
+                                  per second (optional).')
+
+    parser.add_argument('--critpublish', dest='critpublish', type=float, default=None,
+                            help='Critical level for the total publish rate (optional).')
+
+    parser.add_argument('--warndeliver', dest='warndeliver', type=float, default=None,
+                            help='Warn when the total deliver rate in messages per second \
+                                  drops below this level (optional).')
+
+    parser.add_argument('--critdeliver', dest='critdeliver', type=float, default=None,
+                            help='Critical when the total deliver rate drops below this \
+                                  level (optional).')
+
+    parser.add_argument('--perqueue', action='store_true',
+                            help='Add perfdata for every matching queue. Only use \
+                                  this with a --name that matches a few queues.')
+
+    parser.add_argument('--pagesize', dest='pagesize', type=int, default=500,
+                            help='Number of queues to fetch in each request. Default is 500.')
+
+    parser.add_argument('--user', dest='user', type=str, default='guest',
+                            help='User name for the management interface. Default is guest.')
+
+    parser.add_argument('--password', dest='password', type=str, default='guest',
+                            help='Password for the management interface. Default is guest.')
+
+    parser.add_argument('--ssl', action='store_true',
+                            help='Use https to talk to the management interface.')
+
+    parser.add_argument('--cacert', dest='cacert', type=str, default=None,
+                            help='CA certificate file used to verify the server with --ssl.')
+
+    parser.add_argument('--insecure', action='store_true',
+                            help='Don\'t verify the server certificate with --ssl.')
+
+    parser.add_argument('--timeout', dest='timeout', type=float, default=10,
+                            help='Seconds to wait for the management interface. Default is 10.')
+
+    parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+    args = parser.parse_args(argv)
+
+    # Assign command line args to variable names
+    hostName = args.host
+    portNum = args.port
+    warnDepth = args.warn
+    critDepth = args.crit
+    warnUnacked = args.warnunacked
+    critUnacked = args.critunacked
+    warnPublish = args.warnpublish
+    critPublish = args.critpublish
+    warnDeliver = args.warndeliver
+    critDeliver = args.critdeliver
+
+    if critDepth <= warnDepth:
+        print
+        print "ERROR: Critical value must be larger than warning value."
+        printUsage()
+        exit(2)
+
+    if warnUnacked is not None and critUnacked is not None and critUnacked <= warnUnacked:
+        print
+        print "ERROR: Critical unacked value must be larger than warning value."
+        printUsage()
+        exit(2)
+
+    if warnPublish is not None and critPublish is not None and critPublish <= warnPublish:
+        print
+        print "ERROR: Critical publish value must be larger than warning value."
+        printUsage()
+        exit(2)
+
+    if warnDeliver is not None and critDeliver is not None and critDeliver >= warnDeliver:
+        print
+        print "ERROR: Critical deliver value must be smaller than warning value."
+        printUsage()
+        exit(2)
+
+    if args.pagesize < 1:
+        print
+        print "ERROR: Page size must be at least 1."
+        printUsage()
+        exit(2)
+
+    # The network modules are slow to import so they are only
+    # loaded once the arguments are known to be good.
+    import socket
+    import ssl
+    import httplib
+    import base64
+    import urllib
+
+
+    # Only these columns are sent back for each queue
+    queueColumns = ['name', 'vhost', 'messages_ready', 'messages_unacknowledged',
+                    'message_stats.publish_details.rate',
+                    'message_stats.deliver_get_details.rate']
+    # Most queues to name in the status message. Critical queues are
+    # named before warning ones so they are never hidden behind them.
+    maxStatusQueues = 10
+    critQueueList = []
+    warnQueueList = []
+
+    statusMsgList = []
+    statusMsg = ""
+    perfdataMsg = ""
+    queueCount = 0
+    totalReady = 0
+    totalUnacked = 0
+    maxReady = 0
+    publishRate = 0.0
+    deliverRate = 0.0
+    warnCount = 0
+    critCount = 0
+    exitCode = 3
+
+
+    # The connection to the management interface is kept open
+    # and reused for each page of queues.
+    if args.ssl:
+        context = ssl.create_default_context(cafile=args.cacert)
+        if args.insecure:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        conn = httplib.HTTPSConnection(hostName, portNum, timeout=args.timeout, context=context)
+    else:
+        conn = httplib.HTTPConnection(hostName, portNum, timeout=args.timeout)
+
+    # GET a path from the management HTTP API and return the parsed JSON
+    def apiGet(path):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(args.user + ':' + args.password),
+                   'Accept': 'application/json',
+                   'Connection': 'keep-alive'}
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise httplib.HTTPException('HTTP ' + str(response.status) + ' ' + response.reason + ' for ' + path)
+        return json.loads(body)
+
+    # Path for one page of queues
+    def queuesPath(page):
+        path = '/api/queues'
+        if args.vhost:
+            path += '/' + urllib.quote(args.vhost, safe='')
+        query = {'columns': ','.join(queueColumns),
+                 'page': page,
+                 'page_size': args.pagesize}
+        if args.name:
+            query['name'] = args.name
+            query['use_regex'] = 'true'
+        return path + '?' + urllib.urlencode(query)
+
+    # Rate from the message_stats of a queue. Idle queues have none.
+    def queueRate(queue, stat):
+        return queue.get('message_stats', {}).get(stat, {}).get('rate', 0.0)
+
+
+    ##################################################
+    # Fetch the queues a page at a time. Only running
+    # totals and the queues over their levels are kept
+    # so memory use doesn't grow with the queue count.
+    page = 1
+    pageCount = 1
+    try:
+        while page <= pageCount:
+            responseData = apiGet(queuesPath(page))
+            # Servers without paging return every queue in one list
+            if isinstance(responseData, list):
+                queues = responseData
+            else:
+                queues = responseData['items']
+                pageCount = responseData['page_count']
+            if args.debug:
+                print 'PAGE ' + str(page) + ' of ' + str(pageCount) + ': ' + str(len(queues)) + ' queues'
+            for queue in queues:
+                # Queues in the default vhost are shown by name alone
+                queueName = queue['name']
+                if queue['vhost'] != '/':
+                    queueName = queue['vhost'] + '/' + queueName
+                ready = queue.get('messages_ready', 0) or 0
+                unacked = queue.get('messages_unacknowledged', 0) or 0
+                queueCount += 1
+                totalReady += ready
+                totalUnacked += unacked
+                maxReady = max(maxReady, ready)
+                publishRate += queueRate(queue, 'publish_details')
+                deliverRate += queueRate(queue, 'deliver_get_details')
+
+                queueMsg = queueName + ':' + str(ready) + '/' + str(unacked)
+                if ready >= critDepth or (critUnacked is not None and unacked >= critUnacked):
+                    critCount += 1
+                    if len(critQueueList) < maxStatusQueues:
+                        critQueueList.append(queueMsg + ' CRIT')
+                elif ready >= warnDepth or (warnUnacked is not None and unacked >= warnUnacked):
+                    warnCount += 1
+                    if len(warnQueueList) < maxStatusQueues:
+                        warnQueueList.append(queueMsg + ' WARN')
+
+                if args.perqueue:
+                    perfdataMsg += queueName + '_ready=' + str(ready) + ';' + str(warnDepth) + ';' \
+                                   + str(critDepth) + ';0; '
+                    perfdataMsg += queueName + '_unacked=' + str(unacked) + ';;;0; '
+            page += 1
+    except (socket.error, httplib.HTTPException, ValueError, KeyError) as e:
+        return CheckResult(3, "UNKNOWN - Queue depth [Can't get queue list: " + str(e) + "]", '', '')
+
+    statusMsgList = (critQueueList + warnQueueList)[:maxStatusQueues]
+    if warnCount + critCount > len(statusMsgList):
+        statusMsgList.append('and ' + str(warnCount + critCount - len(statusMsgList)) + ' more')
+
+    # The total publish rate alerts when it reaches its levels and the
+    # total deliver rate when it drops below them, for example when the
+    # consumers have stopped. Rate alerts are shown before the queues.
+    rateMsgList = []
+    if critPublish is not None and publishRate >= critPublish:
+        critCount += 1
+        rateMsgList.append('publish_rate:%.2f CRIT' % publishRate)
+    elif warnPublish is not None and publishRate >= warnPublish:
+        warnCount += 1
+        rateMsgList.append('publish_rate:%.2f WARN' % publishRate)
+    if critDeliver is not None and deliverRate < critDeliver:
+        critCount += 1
+        rateMsgList.append('deliver_rate:%.2f CRIT' % deliverRate)
+    elif warnDeliver is not None and deliverRate < warnDeliver:
+        warnCount += 1
+        rateMsgList.append('deliver_rate:%.2f WARN' % deliverRate)
+    statusMsgList = rateMsgList + statusMsgList
+
+    # Levels for perfdata output. Unset levels are left empty and the
+    # deliver levels are ranges that alert below them.
+    def perfLevel(level, suffix=''):
+        if level is None:
+            return ''
+        return '%g' % level + suffix
+
+
+    # Set exit code based on number of warnings and criticals
+    if warnCount == 0 and critCount == 0:
+        statusMsgList.insert(0, "OK - Queue depth (" + str(queueCount) + " queues")
+        exitCode = 0
+    elif warnCount > 0 and critCount == 0:
+        statusMsgList.insert(0, "WARNING - Queue depth (" + str(queueCount) + " queues")
+        exitCode = 1
+    elif critCount > 0:
+        statusMsgList.insert(0, "CRITICAL - Queue depth (" + str(queueCount) + " queues")
+        exitCode = 2
+    else:
+        statusMsgList.insert(0, "UNKNOWN - Queue depth (" + str(queueCount) + " queues")
+        exitCode = 3
+
+    # Build status message output
+    for msg in statusMsgList:
+        statusMsg += msg + " "
+
+    # Finalize status message
+    statusMsg += ") [W:" + str(warnDepth) + " C:" + str(critDepth) + "]"
+
+    # Build perfdata output
+    perfdataMsg = "queues=" + str(queueCount) + ";;;0; " \
+                  + "messages_ready=" + str(totalReady) + ";;;0; " \
+                  + "messages_unacknowledged=" + str(totalUnacked) + ";;;0; " \
+                  + "max_ready=" + str(maxReady) + ";" + str(warnDepth) + ";" + str(critDepth) + ";0; " \
+                  + "publish_rate=%.2f;" % publishRate + perfLevel(warnPublish) + ";" \
+                  + perfLevel(critPublish) + ";0; " \
+                  + "deliver_rate=%.2f;" % deliverRate + perfLevel(warnDeliver, ':') + ";" \
+                  + perfLevel(critDeliver, ':') + ";0; " \
+                  + perfdataMsg
+
+    # Final output for Nagios
+    return CheckResult(exitCode, statusMsg, perfdataMsg, '')
+
+
+if __name__ == '__main__':
+    result = main()
+    output = result.message
+    if result.perfdata is not None:
+        output += '|' + result.perfdata
+    if result.long_output:
+        output += '\n' + result.long_output
+    print output
+    exit(result.state)
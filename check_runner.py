@@ -0,0 +1,385 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This script runs many of the Nagios checks in this repo from one
+# long running process and sends their results to Nagios as passive
+# service checks. Each check script is imported once and its main()
+# is called for every run, so python startup and the imports of boto,
+# MySQLdb and so on are only paid once instead of on every check.
+#
+# The checks file has one check per line:
+#
+#   host_name  service_description  interval  script  [arguments...]
+#
+# Lines are split like a shell command line so quote a service
+# description that has spaces in it. The interval is in seconds and
+# scripts without a path are looked for next to this script.
+# For example:
+#
+#   mq01  "RabbitMQ queues"  60  check_rabbitmq_queues.py --host mq01 --port 15672 --warn 100 --crit 1000
+#   db02  "Slave lag"        30  check_mysql_slave_lag.py --host db02 --user nagios --pass secret --warn 10 --crit 60
+#
+# Results are written to the Nagios command file as
+# PROCESS_SERVICE_CHECK_RESULT commands, a batch at a time. Nagios
+# needs check_external_commands and accept_passive_service_checks
+# turned on and the services set up as passive checks.
+#
+# Checks run on a pool of threads. A check can't be stopped once it
+# has started, so give every check its own timeouts. A check that is
+# still running when it is due again is skipped for that interval and
+# reported as UNKNOWN, and with --once a check that runs for longer
+# than its interval is reported as UNKNOWN and not waited for. Checks
+# that never return, like check_mysql_slave_lag.py --daemon, can't be
+# run this way.
+#
+
+import sys
+import os
+import re
+import imp
+import time
+import random
+import shlex
+import threading
+import argparse
+import Queue
+from collections import OrderedDict
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--checks /etc/nagios/runner.checks --commandfile /usr/local/nagios/var/rw/nagios.cmd"
+    print
+
+#Parse command line arguments
+parser = argparse.ArgumentParser(description='This script runs Nagios checks from this repo \
+                                    in one process and sends the results to Nagios as \
+                                    passive checks.')
+
+parser.add_argument('--checks', dest='checks', type=str, required=True,
+                        help='File listing the checks to run.')
+
+parser.add_argument('--commandfile', dest='commandfile', type=str,
+                        default='/usr/local/nagios/var/rw/nagios.cmd',
+                        help='Nagios command file to write results to. Use - to print \
+                              them instead. Default is /usr/local/nagios/var/rw/nagios.cmd.')
+
+parser.add_argument('--threads', dest='threads', type=int, default=32,
+                        help='Most checks to run at once. Default is 32.')
+
+parser.add_argument('--perscript', dest='perscript', type=int, default=0,
+                        help='Most checks of the same script to run at once. \
+                              Default is 0 (no limit other than --threads).')
+
+parser.add_argument('--batchinterval', dest='batchinterval', type=float, default=1,
+                        help='Seconds between writes to the command file. Default is 1.')
+
+parser.add_argument('--once', action='store_true',
+                        help='Run every check once, send the results and exit.')
+
+parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+args = parser.parse_args()
+
+if args.threads < 1 or args.perscript < 0 or args.batchinterval <= 0:
+    print
+    print "ERROR: --threads must be at least 1, --perscript can't be negative and"
+    print "       --batchinterval must be more than 0."
+    printUsage()
+    exit(2)
+
+# Writes of up to PIPE_BUF bytes to a FIFO are never mixed with
+# writes from other processes, so each write to the command file
+# is kept within this many bytes.
+maxWriteSize = 4096
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+
+##################################################
+# Output printed by a check is kept apart for each
+# thread so that a check that prints a message and
+# exits can still be reported.
+class ThreadOutput(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            self.stream.write(text)
+        else:
+            buf.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buf', None) is None:
+            self.stream.flush()
+
+    def capture(self):
+        self.local.buf = StringIO()
+
+    def release(self):
+        text = self.local.buf.getvalue()
+        self.local.buf = None
+        return text
+
+stdoutCapture = ThreadOutput(sys.stdout)
+stderrCapture = ThreadOutput(sys.stderr)
+
+
+##################################################
+# Read the checks file. Each check is a dict with
+# the host, service, interval, script path, module
+# and arguments, and its scheduling state.
+modules = {}
+
+def loadScript(script):
+    if not os.path.isabs(script) and os.sep not in script:
+        script = os.path.join(scriptDir, script)
+    script = os.path.abspath(script)
+    if script not in modules:
+        # Scripts like check-template-json-webservice.py aren't valid
+        # module names so they are loaded from their path.
+        moduleName = re.sub(r'\W', '_', os.path.splitext(os.path.basename(script))[0])
+        modules[script] = imp.load_source(moduleName, script)
+    return script, modules[script]
+
+checks = []
+with open(args.checks) as f:
+    for lineNum, line in enumerate(f, 1):
+        fields = shlex.split(line, comments=True)
+        if not fields:
+            continue
+        if len(fields) < 4:
+            print "ERROR: " + args.checks + " line " + str(lineNum) + \
+                  " needs host_name, service_description, interval and script."
+            exit(2)
+        try:
+            script, module = loadScript(fields[3])
+        except (IOError, SyntaxError, ImportError) as e:
+            print "ERROR: Can't load " + fields[3] + " on line " + str(lineNum) + ": " + str(e)
+            exit(2)
+        if not hasattr(module, 'main'):
+            print "ERROR: " + fields[3] + " on line " + str(lineNum) + " has no main()."
+            exit(2)
+        if '--daemon' in fields[4:]:
+            print "ERROR: " + fields[3] + " on line " + str(lineNum) + \
+                  " can't be run with --daemon, it never returns."
+            exit(2)
+        checks.append({'host': fields[0],
+                       'service': fields[1],
+                       'interval': float(fields[2]),
+                       'script': script,
+                       'module': module,
+                       'args': fields[4:],
+                       'next': 0,
+                       'started': 0,
+                       'overdue': 0,
+                       'running': False,
+                       'counted': False})
+
+if not checks:
+    print "ERROR: No checks in " + args.checks
+    exit(2)
+
+# Spread the first runs over each check's interval so they don't
+# all start at once.
+startTime = time.time()
+if not args.once:
+    for check in checks:
+        check['next'] = startTime + random.uniform(0, check['interval'])
+
+
+##################################################
+# Run one check and return its result. main() of each
+# check returns a result with the state, message,
+# perfdata and long output. A check that exits is
+# reported with what it printed and one that raises
+# an error is UNKNOWN.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
+
+def runCheck(check):
+    stdoutCapture.capture()
+    stderrCapture.capture()
+    try:
+        try:
+            result = check['module'].main(check['args'])
+        except SystemExit as e:
+            exitCode = e.code
+            if exitCode is None:
+                exitCode = 0
+            elif not isinstance(exitCode, int):
+                exitCode = 3
+            result = CheckResult(exitCode, '', None, '')
+        except Exception as e:
+            result = CheckResult(3, 'UNKNOWN - ' + os.path.basename(check['script']) + ' failed: '
+                                 + e.__class__.__name__ + ': ' + str(e), None, '')
+    finally:
+        printed = stdoutCapture.release()
+        errors = stderrCapture.release()
+    if not result.message:
+        # A check that exits prints its message and any details after it
+        lines = (printed.strip() or errors.strip() or 'Check exited with no output').split('\n', 1)
+        result = result._replace(message=lines[0], long_output='\n'.join(lines[1:]))
+    if result.state not in (0, 1, 2, 3):
+        result = result._replace(state=3)
+    return [check, result, time.time()]
+
+
+##################################################
+# Results are sent as external commands. Only the
+# newest result for each service is kept until it
+# is written, so pending results can't pile up when
+# the command file can't be opened.
+pending = OrderedDict()
+results = Queue.Queue()
+
+def commandLine(host, service, result, checkTime):
+    output = result.message
+    if result.perfdata is not None:
+        output += '|' + result.perfdata
+    if result.long_output:
+        output += '\n' + result.long_output
+    # Nagios turns \n back into new lines in plugin output
+    output = output.strip().replace('\\', '\\\\').replace('\n', '\\n')
+    line = '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;' % (checkTime, host, service, result.state)
+    # Keep each command small enough to go in one write
+    return line + output[:maxWriteSize - len(line) - 1] + '\n'
+
+def writeResults():
+    if not pending:
+        return
+    lines = pending.values()
+    try:
+        if args.commandfile == '-':
+            commandFile = sys.stdout
+        else:
+            commandFile = open(args.commandfile, 'a', 0)
+        try:
+            batch = ''
+            for line in lines:
+                if len(batch) + len(line) > maxWriteSize:
+                    commandFile.write(batch)
+                    batch = ''
+                batch += line
+            commandFile.write(batch)
+            commandFile.flush()
+        finally:
+            if commandFile is not sys.stdout:
+                commandFile.close()
+    except IOError as e:
+        sys.stderr.write('Can\'t write to ' + args.commandfile + ': ' + str(e) + '\n')
+        return
+    if args.debug:
+        sys.stderr.write('Sent ' + str(len(lines)) + ' results\n')
+    pending.clear()
+
+def finishCheck(result):
+    results.put(result)
+
+
+##################################################
+# Start checks when they are due as long as the
+# thread and per script limits allow, and send the
+# results as they come in.
+sys.stdout = stdoutCapture
+sys.stderr = stderrCapture
+
+pool = ThreadPool(args.threads)
+runningCount = 0
+scriptRunning = {}
+nextWrite = time.time() + args.batchinterval
+remaining = len(checks)
+
+while True:
+    now = time.time()
+    for check in checks:
+        if check['running'] or check['next'] > now:
+            continue
+        if args.once and check['next'] < 0:
+            continue
+        if runningCount >= args.threads:
+            break
+        if args.perscript and scriptRunning.get(check['script'], 0) >= args.perscript:
+            continue
+        check['running'] = True
+        check['started'] = now
+        check['overdue'] = now + check['interval']
+        runningCount += 1
+        scriptRunning[check['script']] = scriptRunning.get(check['script'], 0) + 1
+        if args.once:
+            check['next'] = -1
+        else:
+            # A run that starts late doesn't make up for the time lost
+            check['next'] += check['interval']
+            if check['next'] < now:
+                check['next'] = now + check['interval']
+        pool.apply_async(runCheck, (check,), callback=finishCheck)
+
+    # Report checks still running after their interval. With --once
+    # they are counted as done so the runner doesn't wait for them.
+    for check in checks:
+        if check['running'] and check['overdue'] <= now:
+            pending.pop((check['host'], check['service']), None)
+            pending[(check['host'], check['service'])] = commandLine(
+                check['host'], check['service'],
+                CheckResult(3, 'UNKNOWN - ' + os.path.basename(check['script']) + ' still running after '
+                            + '%d seconds' % (now - check['started']), None, ''), now)
+            check['overdue'] += check['interval']
+            if args.once and not check['counted']:
+                check['counted'] = True
+                remaining -= 1
+
+    # Wait for a result, the next due check, the next overdue
+    # check or the next write
+    wakeTime = nextWrite
+    for check in checks:
+        if check['running']:
+            wakeTime = min(wakeTime, check['overdue'])
+        elif check['next'] >= 0:
+            wakeTime = min(wakeTime, check['next'])
+    try:
+        result = results.get(True, max(0.01, wakeTime - time.time()))
+    except Queue.Empty:
+        result = None
+    while result is not None:
+        check, checkResult, checkTime = result
+        check['running'] = False
+        runningCount -= 1
+        scriptRunning[check['script']] -= 1
+        # With --once a check already reported as still running is done
+        if not (args.once and check['counted']):
+            check['counted'] = True
+            remaining -= 1
+            key = (check['host'], check['service'])
+            pending.pop(key, None)
+            pending[key] = commandLine(check['host'], check['service'], checkResult, checkTime)
+            if args.debug:
+                sys.stderr.write(check['host'] + ';' + check['service'] + ' ' + str(checkResult.state) + ' '
+                                 + checkResult.message + '\n')
+        try:
+            result = results.get_nowait()
+        except Queue.Empty:
+            result = None
+
+    if args.once and remaining == 0:
+        writeResults()
+        break
+    if time.time() >= nextWrite:
+        writeResults()
+        nextWrite = time.time() + args.batchinterval
+
+pool.close()
+sys.stdout = stdoutCapture.stream
+sys.stderr = stderrCapture.stream
@@ -31,164 +31,655 @@
 #    3 = UNKNOWN/purple
 #
 
-import ConfigParser
 import os
 import datetime
-import dateutil.parser
-from dateutil.tz import *
 import time
+import calendar
+import math
+import sqlite3
 import socket
-import boto
 import argparse
 import re
+import threading
+from collections import Counter
+from collections import namedtuple
+import csv
+import json
+import urllib
+import gzip
+from cStringIO import StringIO
 
-#Parse command line arguments
-parser = argparse.ArgumentParser(description='This script is a Nagios check that \
-                                              monitors the age of files that have \
-                                              been backed up to an S3 bucket.')
+#Result of a check. state is the Nagios exit code and message the status
+#line. perfdata is None when there is no perfdata and long_output holds
+#any lines that go after the first.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
 
-parser.add_argument('--bucketname', dest='bucketname', type=str, required=True,
-                    help='Name of S3 bucket')
+#Convert a timezone aware datetime to seconds since the epoch
+def toEpoch(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
 
-parser.add_argument('--minfileage', dest='minfileage', type=int, default=0,
-                    help='Minimum age for files in an S3 bucket in hours. \
-                          Default is 0 hours (disabled).\
-                          ')
+#LastModified in a bucket listing is always in the fixed format
+#2017-01-07T12:34:56.000Z so it is sliced apart here instead of going
+#through dateutil, which is the slowest part of the key loop. Anything
+#in another format falls back to dateutil.
+def parseLastModified(lastmodified):
+    if len(lastmodified) == 24 and lastmodified[10] == 'T' and lastmodified[23] == 'Z':
+        try:
+            return calendar.timegm((int(lastmodified[0:4]), int(lastmodified[5:7]),
+                                    int(lastmodified[8:10]), int(lastmodified[11:13]),
+                                    int(lastmodified[14:16]), int(lastmodified[17:19]))) \
+                   + int(lastmodified[20:23]) / 1000.0
+        except ValueError:
+            pass
+    import dateutil.parser
+    return toEpoch(dateutil.parser.parse(lastmodified))
 
-parser.add_argument('--maxfileage', dest='maxfileage', type=int, default=0,
-                    help='Maximum age for files in an S3 bucket in hours. \
-                          Default is 0 hours (disabled).')
+#Same output as str(dateutil.parser.parse(lastmodified).replace(tzinfo=tzutc()))
+def formatLastModified(lastmodified):
+    if len(lastmodified) == 24 and lastmodified[10] == 'T' and lastmodified[23] == 'Z' \
+       and lastmodified[20:23].isdigit():
+        if lastmodified[20:23] == '000':
+            return lastmodified[0:10] + ' ' + lastmodified[11:19] + '+00:00'
+        return lastmodified[0:10] + ' ' + lastmodified[11:19] + '.' \
+               + lastmodified[20:23] + '000+00:00'
+    import dateutil.parser
+    from dateutil.tz import tzutc
+    return str(dateutil.parser.parse(lastmodified).replace(tzinfo=tzutc()))
 
-parser.add_argument('--bucketfolder', dest='bucketfolder', type=str, default='', 
-                    help='Folder to check inside bucket (optional).')
-####
-# Add arg option for s3 region?
-###
+#The check runs in main() so it can also be imported and run in-process.
+#It returns a CheckResult. Bad arguments and a few fatal errors print a
+#message and exit instead.
+def main(argv=None):
 
-parser.add_argument('--listfiles', action='store_true',
-                    help='Enables listing of all files in bucket to stdout. \
-                          Use with caution!')
+    #Parse command line arguments
+    parser = argparse.ArgumentParser(description='This script is a Nagios check that \
+                                                  monitors the age of files that have \
+                                                  been backed up to an S3 bucket.')
 
-parser.add_argument('--debug', action='store_true',
-                    help='Enables debug output.')
+    parser.add_argument('--bucketname', dest='bucketname', type=str, required=True,
+                        help='Name of S3 bucket')
 
-args = parser.parse_args()
+    parser.add_argument('--minfileage', dest='minfileage', type=int, default=0,
+                        help='Minimum age for files in an S3 bucket in hours. \
+                              Default is 0 hours (disabled).\
+                              ')
 
-#Assign variables from command line arguments
-bucketname = args.bucketname
-minfileage = args.minfileage
-maxfileage = args.maxfileage
-bucketfolder  = args.bucketfolder
-bucketfolder_regex = '^' + bucketfolder
+    parser.add_argument('--maxfileage', dest='maxfileage', type=int, default=0,
+                        help='Maximum age for files in an S3 bucket in hours. \
+                              Default is 0 hours (disabled).')
 
-maxfilecount = 0
-minfilecount = 0
-totalfilecount = 0
+    parser.add_argument('--bucketfolder', dest='bucketfolder', type=str, default='', 
+                        help='Folder to check inside bucket (optional).')
+    ####
+    # Add arg option for s3 region?
+    ###
 
-if (args.debug):
-    print '########## START DEBUG OUTPUT ############'
-    print 'DEBUG: S3 BUCKET NAME: ' + str(bucketname)
-    print 'DEBUG: MIN FILE AGE: ' + str(minfileage)
-    print 'DEBUG: MAX FILE AGE: ' + str(maxfileage)
+    parser.add_argument('--prefixes', dest='prefixes', type=str, default='',
+                        help='Comma separated list of sub-prefixes inside bucketfolder. \
+                              Each sub-prefix is listed in parallel. Files outside \
+                              these sub-prefixes are not checked.')
 
+    parser.add_argument('--sharddelimiter', dest='sharddelimiter', type=str, default='',
+                        help='Split the listing on this delimiter (for example /) \
+                              and list each resulting sub-prefix in parallel.')
 
-if (args.debug):
-    print "DEBUG: Connecting to S3"
+    parser.add_argument('--threads', dest='threads', type=int, default=8,
+                        help='Number of parallel listing threads used with \
+                              --prefixes or --sharddelimiter. Default is 8.')
 
-s3 = boto.connect_s3()
+    parser.add_argument('--statefile', dest='statefile', type=str, default='',
+                        help='Path to a sqlite state file used for incremental \
+                              scans (optional). Only files that sort after the \
+                              last file seen are listed on each run.')
 
-if (args.debug):
-    print "DEBUG: S3 Connection: %s" % s3
+    parser.add_argument('--rescaninterval', dest='rescaninterval', type=float, default=24,
+                        help='Hours between full rescans when --statefile is used. \
+                              Default is 24 hours.')
+
+    parser.add_argument('--inventory', dest='inventory', type=str, default='',
+                        help='Read files from a local S3 Inventory instead of listing \
+                              the bucket (optional). This can be a manifest.json or \
+                              a single CSV data file (.csv or .csv.gz).')
+
+    parser.add_argument('--inventoryschema', dest='inventoryschema', type=str,
+                        default='Bucket, Key, Size, LastModifiedDate, StorageClass',
+                        help='Columns of an S3 Inventory data file given without \
+                              its manifest.json. Default is \
+                              "Bucket, Key, Size, LastModifiedDate, StorageClass".')
+
+    parser.add_argument('--fast', action='store_true',
+                        help='Stop listing files as soon as the result can no \
+                              longer change. File counts in the output are then \
+                              shown as lower bounds (>=).')
+
+    parser.add_argument('--listfiles', action='store_true',
+                        help='Enables listing of all files in bucket to stdout. \
+                              Use with caution!')
+
+    parser.add_argument('--export', dest='export', type=str, default='',
+                        help='Write every file checked to this path (optional). \
+                              The file is gzip compressed if the path ends in .gz. \
+                              With --statefile only newly listed files are written.')
+
+    parser.add_argument('--exportformat', dest='exportformat', type=str, default='csv',
+                        choices=['csv', 'ndjson'],
+                        help='Format of the --export file. Default is csv.')
+
+    parser.add_argument('--debug', action='store_true',
+                        help='Enables debug output.')
+
+    args = parser.parse_args(argv)
+
+    if args.prefixes and args.sharddelimiter:
+        parser.error('--prefixes and --sharddelimiter can not be used together.')
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
+    if args.statefile and args.prefixes:
+        parser.error('--statefile can not be used with --prefixes.')
+    if args.statefile and args.fast:
+        parser.error('--statefile can not be used with --fast.')
+    if args.inventory and (args.statefile or args.prefixes or args.sharddelimiter):
+        parser.error('--inventory can not be used with --statefile, --prefixes or --sharddelimiter.')
+
+    #Assign variables from command line arguments
+    bucketname = args.bucketname
+    minfileage = args.minfileage
+    maxfileage = args.maxfileage
+    bucketfolder  = args.bucketfolder
+    bucketfolder_regex = '^' + bucketfolder
+    bucketfolder_match = re.compile(bucketfolder_regex).match
+
+    maxfilecount = 0
+    minfilecount = 0
+    totalfilecount = 0
 
-# Check if bucket exists. Exit with critical if it doesn't
-nonexistent = s3.lookup(bucketname)
-if nonexistent is None:
-    print "CRITICAL: No bucket found with a name of " + str(bucketname)
-    exit(2)
-else:
     if (args.debug):
-        print "DEBUG: Hooray the bucket " + str(bucketname) + " was found!"
-
-bucket = s3.get_bucket(bucketname)
-if (args.debug):
-    print "Bucket: %s" % bucket
-
-#Figure out time delta between current time and max/min file age
-maxagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=maxfileage)
-if (args.debug):
-    print  'MAX AGE TIME: ' + str(maxagetime)
-
-minagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=minfileage)
-if (args.debug):
-    print  'MIN AGE TIME: ' + str(minagetime)
-
-#Loop through keys (files) in the S3 bucket and
-#check each one for min and max file age.
-for key in bucket.list(prefix=bucketfolder):
-    if (re.match(bucketfolder_regex,str(key.name))):
-        if (args.listfiles):
-            print '|' + str(key.storage_class) + '|' + str(key.name) + '|' \
-                  + str(dateutil.parser.parse(key.last_modified).replace(tzinfo=tzutc()))
-        if dateutil.parser.parse(key.last_modified) < maxagetime:
-            if (args.listfiles):
-                print 'Found file older than maxfileage of ' + str(maxfileage) + ' hours'
-            maxfilecount += 1
-        #print key.__dict__
-        if dateutil.parser.parse(key.last_modified) > minagetime:
-            if (args.listfiles):
-                print 'Found file newer than minfileage of ' + str(minfileage) + ' hours'
-            minfilecount += 1
-        totalfilecount += 1
-
-#Begin formatting status message for Nagios output
-#This is conditionally formatted based on requested min/max options.
-msg = ' -'
-if minfileage > 0:
-    msg = msg + ' MIN:' + str(minfileage) + 'hrs'
-if maxfileage > 0:
-    msg = msg + ' MAX:' + str(maxfileage) + 'hrs'
-
-if maxfileage > 0:
-      msg = msg + ' - Files exceeding MAX time: ' + str(maxfilecount)
-
-if minfileage > 0:
-      msg = msg + ' - Files meeting MIN time: ' + str(minfilecount)
-
-msg = msg + ' - Total file count: ' + str(totalfilecount)
-
-
-#I think there probably is a better way of doing this but what I have here works.
-#
-# Decide exit code for Nagios based on maxfilecount and minfilecount results.
-#
-# maxfilecount should equal zero for green/OK
-# minfilecount should be greater than zero for green/OK
-#
-if minfileage == 0 and maxfileage == 0:
-    statusline = 'WARNING: No max or min specified. Please specify at least one.' + msg
-    exitcode = 1
-elif maxfilecount == 0 and minfilecount > 0:
-    statusline = 'OK: No S3 files exceeding time boundaries.' + msg
-    exitcode = 0
-elif (maxfilecount > 0 or minfilecount == 0) and maxfileage > 0 and minfileage > 0:
-    statusline = 'CRITICAL: S3 files exceed time boundaries.' + msg
-    exitcode = 2
-elif maxfilecount > 0 and maxfileage > 0 and minfileage == 0:
-    statusline = 'CRITICAL: S3 files exceed MAX time boundaries.' + msg
-    exitcode = 2
-elif minfilecount == 0 and maxfileage == 0 and minfileage > 0:
-    statusline = 'CRITICAL: S3 files do not meet MIN time requirement.' + msg
-    exitcode = 2
-elif minfilecount > 0 and maxfileage == 0 and minfileage > 0:
-    statusline = 'OK: S3 files meet MIN time boundaries.' + msg
-    exitcode = 0
-elif maxfilecount == 0 and maxfileage > 0 and minfileage == 0:
-    statusline = 'OK: S3 files meet MAX time boundaries.' + msg
-    exitcode = 0
-else:
-    statusline = 'UNKNOWN: ' + msg
-    exitcode = 3
-
-print statusline
-exit(exitcode)
+        print '########## START DEBUG OUTPUT ############'
+        print 'DEBUG: S3 BUCKET NAME: ' + str(bucketname)
+        print 'DEBUG: MIN FILE AGE: ' + str(minfileage)
+        print 'DEBUG: MAX FILE AGE: ' + str(maxfileage)
+
+
+    if args.inventory:
+        bucket = None
+        if (args.debug):
+            print 'DEBUG: Reading S3 Inventory: ' + args.inventory
+    else:
+        if (args.debug):
+            print "DEBUG: Connecting to S3"
+
+        # boto is slow to import so it is only loaded once the
+        # arguments are known to be good and a bucket is needed.
+        import boto
+        s3 = boto.connect_s3()
+
+        if (args.debug):
+            print "DEBUG: S3 Connection: %s" % s3
+
+        # Check if bucket exists. Exit with critical if it doesn't
+        nonexistent = s3.lookup(bucketname)
+        if nonexistent is None:
+            print "CRITICAL: No bucket found with a name of " + str(bucketname)
+            exit(2)
+        else:
+            if (args.debug):
+                print "DEBUG: Hooray the bucket " + str(bucketname) + " was found!"
+
+        bucket = s3.get_bucket(bucketname)
+        if (args.debug):
+            print "Bucket: %s" % bucket
+
+    #Figure out time delta between current time and max/min file age
+    from dateutil.tz import tzutc
+    maxagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=maxfileage)
+    if (args.debug):
+        print  'MAX AGE TIME: ' + str(maxagetime)
+
+    minagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=minfileage)
+    if (args.debug):
+        print  'MIN AGE TIME: ' + str(minagetime)
+
+    maxageepoch = toEpoch(maxagetime)
+    minageepoch = toEpoch(minagetime)
+    nowepoch = time.time()
+
+    #Incremental scanning. The state file remembers the name of the last
+    #file listed (the marker) and how many files were seen for each
+    #LastModified time. Later runs only list files that sort after the
+    #marker, which works well when new files get increasing names (dated
+    #backups for example). Deleted files, and new files with a name that
+    #sorts before the marker, are only picked up by the next full rescan.
+    marker = ''
+    if args.statefile:
+        statedb = sqlite3.connect(args.statefile)
+        statedb.execute('CREATE TABLE IF NOT EXISTS scanstate (bucket TEXT, prefix TEXT, \
+                         marker TEXT, lastfullscan REAL, PRIMARY KEY (bucket, prefix))')
+        statedb.execute('CREATE TABLE IF NOT EXISTS keyages (bucket TEXT, prefix TEXT, \
+                         modified REAL, files INTEGER, bytes INTEGER, \
+                         PRIMARY KEY (bucket, prefix, modified))')
+        staterow = statedb.execute('SELECT marker, lastfullscan FROM scanstate \
+                                    WHERE bucket = ? AND prefix = ?',
+                                   (bucketname, bucketfolder)).fetchone()
+        scanstart = time.time()
+        if staterow is None or scanstart - staterow[1] >= args.rescaninterval * 3600:
+            lastfullscan = scanstart
+            statedb.execute('DELETE FROM keyages WHERE bucket = ? AND prefix = ?',
+                            (bucketname, bucketfolder))
+            if (args.debug):
+                print 'DEBUG: Full rescan of bucket folder'
+        else:
+            marker, lastfullscan = staterow
+            if (args.debug):
+                print 'DEBUG: Incremental scan after marker: ' + str(marker)
+
+    printlock = threading.Lock()
+    stoplisting = threading.Event()
+
+    #Export file for --export. Each listing thread formats rows into its own
+    #small buffer and only takes the lock to hand a full buffer to the file,
+    #so memory use stays the same no matter how many files are listed.
+    exportlock = threading.Lock()
+    exportflushsize = 65536
+    exportfile = None
+    if args.export:
+        if args.export.endswith('.gz'):
+            exportfile = gzip.open(args.export, 'wb')
+        else:
+            exportfile = open(args.export, 'wb', exportflushsize)
+        if args.exportformat == 'csv':
+            csv.writer(exportfile).writerow(['storage_class', 'name', 'last_modified', 'age'])
+
+    def flushExport(exportbuffer):
+        with exportlock:
+            exportfile.write(exportbuffer.getvalue())
+        exportbuffer.seek(0)
+        exportbuffer.truncate()
+
+    #Age label written to the export file for each file
+    def ageLabel(modifiedepoch):
+        if maxfileage > 0 and modifiedepoch < maxageepoch:
+            return 'old'
+        if minfileage > 0 and modifiedepoch > minageepoch:
+            return 'new'
+        return 'ok'
+    threadlocal = threading.local()
+    threadlocal.bucket = bucket
+
+    def getBucket():
+        # boto connections should not be shared between threads so
+        # each listing thread opens its own.
+        if not hasattr(threadlocal, 'bucket'):
+            threadlocal.bucket = boto.connect_s3().get_bucket(bucketname, validate=False)
+        return threadlocal.bucket
+
+    #Age histogram used for the percentile perfdata. Bucket 0 holds files
+    #less than a minute old and each bucket after that is 2^(1/4) (about
+    #19%) wider than the one before, so 128 buckets cover any file age.
+    agebuckets = 128
+
+    def ageBucket(age):
+        if age < 60:
+            return 0
+        return min(int(math.log(age / 60.0, 2) * 4) + 1, agebuckets - 1)
+
+    def ageBucketEdges(bucket):
+        if bucket == 0:
+            return 0, 60
+        return 60 * 2 ** ((bucket - 1) / 4.0), 60 * 2 ** (bucket / 4.0)
+
+    #Estimate an age percentile from the histogram by interpolating inside
+    #the bucket it falls in. The estimate is kept between the newest and
+    #oldest file ages, which are exact.
+    def agePercentile(result, percent):
+        rank = result['totalfilecount'] * percent / 100.0
+        seen = 0
+        for bucket, files in enumerate(result['agehistogram']):
+            if files and seen + files >= rank:
+                lower, upper = ageBucketEdges(bucket)
+                age = lower + (upper - lower) * (rank - seen) / files
+                return min(max(age, nowepoch - result['newest']), nowepoch - result['oldest'])
+            seen += files
+        return nowepoch - result['oldest']
+
+    #Empty result for checkKeys. The counters, sizes and age histogram all
+    #take the same amount of memory however many files are listed.
+    def newResult():
+        return {'maxfilecount': 0, 'minfilecount': 0, 'totalfilecount': 0,
+                'totalbytes': 0, 'newest': None, 'oldest': None,
+                'agehistogram': [0] * agebuckets,
+                'lastkey': '', 'modified': Counter(), 'modifiedbytes': Counter()}
+
+    def addFileAge(result, modifiedepoch, size, files=1):
+        result['totalbytes'] += size
+        if result['newest'] is None or modifiedepoch > result['newest']:
+            result['newest'] = modifiedepoch
+        if result['oldest'] is None or modifiedepoch < result['oldest']:
+            result['oldest'] = modifiedepoch
+        result['agehistogram'][ageBucket(max(0, nowepoch - modifiedepoch))] += files
+
+    def mergeResult(total, result):
+        for counter in ['maxfilecount', 'minfilecount', 'totalfilecount', 'totalbytes']:
+            total[counter] += result[counter]
+        if result['newest'] is not None:
+            if total['newest'] is None or result['newest'] > total['newest']:
+                total['newest'] = result['newest']
+            if total['oldest'] is None or result['oldest'] < total['oldest']:
+                total['oldest'] = result['oldest']
+        for bucket, files in enumerate(result['agehistogram']):
+            total['agehistogram'][bucket] += files
+        total['lastkey'] = max(total['lastkey'], result['lastkey'])
+        total['modified'].update(result['modified'])
+        total['modifiedbytes'].update(result['modifiedbytes'])
+
+    #Loop through keys (files) and check each one for min and max file age.
+    #Returns a dict with the counters, the last file name seen and (when
+    #a state file is used) the files and bytes for each LastModified time.
+    def checkKeys(keys):
+        result = newResult()
+        if exportfile:
+            exportbuffer = StringIO()
+            exportcsv = csv.writer(exportbuffer)
+        for key in keys:
+            if stoplisting.is_set():
+                break
+            if (bucketfolder_match(str(key.name))):
+                #Output for a key is collected first so lines from
+                #parallel shards don't get mixed together.
+                listlines = []
+                if (args.listfiles):
+                    listlines.append('|' + str(key.storage_class) + '|' + str(key.name) + '|' \
+                                     + formatLastModified(key.last_modified))
+                modifiedepoch = parseLastModified(key.last_modified)
+                if modifiedepoch < maxageepoch:
+                    if (args.listfiles):
+                        listlines.append('Found file older than maxfileage of ' + str(maxfileage) + ' hours')
+                    result['maxfilecount'] += 1
+                #print key.__dict__
+                if modifiedepoch > minageepoch:
+                    if (args.listfiles):
+                        listlines.append('Found file newer than minfileage of ' + str(minfileage) + ' hours')
+                    result['minfilecount'] += 1
+                result['totalfilecount'] += 1
+                addFileAge(result, modifiedepoch, int(key.size))
+                if args.fast and resultDecided(result):
+                    stoplisting.set()
+                if (args.statefile):
+                    result['modified'][modifiedepoch] += 1
+                    result['modifiedbytes'][modifiedepoch] += int(key.size)
+                if exportfile:
+                    exportrow = [str(key.storage_class), key.name.encode('utf-8'),
+                                 formatLastModified(key.last_modified), ageLabel(modifiedepoch)]
+                    if args.exportformat == 'csv':
+                        exportcsv.writerow(exportrow)
+                    else:
+                        exportbuffer.write(json.dumps(dict(zip(['storage_class', 'name',
+                                                                'last_modified', 'age'],
+                                                               exportrow))) + '\n')
+                    if exportbuffer.tell() >= exportflushsize:
+                        flushExport(exportbuffer)
+                if listlines:
+                    with printlock:
+                        print '\n'.join(listlines)
+            result['lastkey'] = max(result['lastkey'], key.name)
+        if exportfile:
+            flushExport(exportbuffer)
+        return result
+
+    def listShard(prefix):
+        if stoplisting.is_set():
+            return checkKeys([])
+        return checkKeys(getBucket().list(prefix=prefix, marker=marker))
+
+    #With --fast the listing stops once a single file decides the result.
+    #One file older than MAX is always CRITICAL. When only MIN is set one
+    #file newer than MIN is enough for OK.
+    def resultDecided(result):
+        if maxfileage > 0 and result['maxfilecount'] > 0:
+            return True
+        if maxfileage == 0 and minfileage > 0 and result['minfilecount'] > 0:
+            return True
+        return False
+
+    #Nothing to decide when neither MIN nor MAX is set
+    if args.fast and minfileage == 0 and maxfileage == 0:
+        stoplisting.set()
+
+    #S3 Inventory input. Each data file of the inventory is read as one
+    #shard, streaming through the (gzip) CSV so that even multi-GB
+    #inventories are never held in memory. Rows are turned into objects
+    #that look like the keys in a bucket listing so they go through the
+    #same checks and give the same output.
+    InventoryKey = namedtuple('InventoryKey', ['name', 'storage_class', 'last_modified', 'size'])
+    inventoryschema = [c.strip() for c in args.inventoryschema.split(',')]
+
+    def inventoryError(msg):
+        print 'UNKNOWN: ' + msg
+        exit(3)
+
+    def inventoryFiles(path):
+        if not os.path.isfile(path):
+            inventoryError('S3 Inventory file not found: ' + path)
+        if not path.endswith('.json'):
+            return [path]
+        manifest = json.load(open(path))
+        if manifest.get('fileFormat', 'CSV') != 'CSV':
+            inventoryError('Only CSV S3 Inventories are supported, not ' + str(manifest['fileFormat']))
+        inventoryschema[:] = [c.strip() for c in manifest['fileSchema'].split(',')]
+        #Data file keys in the manifest are relative to the inventory
+        #destination bucket. Look for them next to the manifest, or in the
+        #data folder of a copy of the destination bucket.
+        manifestdir = os.path.dirname(path)
+        datafiles = []
+        for datafile in manifest['files']:
+            datafilename = os.path.basename(datafile['key'])
+            for candidate in [os.path.join(manifestdir, datafilename),
+                              os.path.join(manifestdir, 'data', datafilename),
+                              os.path.join(manifestdir, '..', 'data', datafilename)]:
+                if os.path.isfile(candidate):
+                    datafiles.append(candidate)
+                    break
+            else:
+                inventoryError('S3 Inventory data file not found: ' + datafile['key'])
+        return datafiles
+
+    def inventoryKeys(rows):
+        columns = dict((column, index) for index, column in enumerate(inventoryschema))
+        bucketcol = columns.get('Bucket')
+        keycol = columns['Key']
+        sizecol = columns.get('Size')
+        modifiedcol = columns['LastModifiedDate']
+        storagecol = columns.get('StorageClass')
+        latestcol = columns.get('IsLatest')
+        deletecol = columns.get('IsDeleteMarker')
+        for row in rows:
+            if bucketcol is not None and row[bucketcol] != bucketname:
+                continue
+            #Skip old versions and delete markers in versioned inventories
+            if (latestcol is not None and row[latestcol] == 'false') \
+               or (deletecol is not None and row[deletecol] == 'true'):
+                continue
+            #Keys are URL encoded in inventory files
+            name = urllib.unquote_plus(row[keycol]).decode('utf-8')
+            if not name.startswith(bucketfolder):
+                continue
+            storageclass = 'STANDARD'
+            if storagecol is not None and row[storagecol]:
+                storageclass = row[storagecol]
+            size = 0
+            if sizecol is not None and row[sizecol]:
+                size = int(row[sizecol])
+            yield InventoryKey(name, storageclass, row[modifiedcol], size)
+
+    def listInventoryFile(path):
+        if stoplisting.is_set():
+            return checkKeys([])
+        if path.endswith('.gz'):
+            inventoryfile = gzip.open(path, 'rb')
+        else:
+            inventoryfile = open(path, 'rb')
+        try:
+            return checkKeys(inventoryKeys(csv.reader(inventoryfile)))
+        finally:
+            inventoryfile.close()
+
+    #Work out which prefixes (shards) to list in parallel. Files that sit
+    #directly under bucketfolder when splitting on a delimiter are checked
+    #while the shards are discovered.
+    shards = []
+    resultlist = []
+    shardlister = listShard
+    if args.inventory:
+        shards = inventoryFiles(args.inventory)
+        shardlister = listInventoryFile
+    elif args.prefixes:
+        shards = [bucketfolder + p.strip() for p in args.prefixes.split(',') if p.strip()]
+    elif args.sharddelimiter:
+        from boto.s3.prefix import Prefix
+        def topLevelKeys():
+            for item in bucket.list(prefix=bucketfolder, delimiter=args.sharddelimiter,
+                                    marker=marker):
+                if isinstance(item, Prefix):
+                    shards.append(item.name)
+                else:
+                    yield item
+        resultlist.append(checkKeys(topLevelKeys()))
+    else:
+        resultlist.append(listShard(bucketfolder))
+
+    if shards:
+        if (args.debug):
+            print 'DEBUG: Listing ' + str(len(shards)) + ' shards with ' \
+                  + str(args.threads) + ' threads'
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(args.threads, len(shards)))
+        resultlist.extend(pool.map(shardlister, shards))
+        pool.close()
+        pool.join()
+
+    if exportfile:
+        exportfile.close()
+
+    #Merge the counters from each shard
+    total = newResult()
+    for result in resultlist:
+        mergeResult(total, result)
+
+    #Add the newly listed files to the state file and take the
+    #counters from everything it has seen since the last full rescan.
+    if args.statefile:
+        modified = total['modified']
+        modifiedbytes = total['modifiedbytes']
+        marker = max(marker, total['lastkey'])
+        statedb.executemany('INSERT OR IGNORE INTO keyages VALUES (?, ?, ?, 0, 0)',
+                            [(bucketname, bucketfolder, m) for m in modified])
+        statedb.executemany('UPDATE keyages SET files = files + ?, bytes = bytes + ? \
+                             WHERE bucket = ? AND prefix = ? AND modified = ?',
+                            [(n, modifiedbytes[m], bucketname, bucketfolder, m)
+                             for m, n in modified.iteritems()])
+        statedb.execute('INSERT OR REPLACE INTO scanstate VALUES (?, ?, ?, ?)',
+                        (bucketname, bucketfolder, marker, lastfullscan))
+        statedb.commit()
+
+        if (args.debug):
+            print 'DEBUG: Files listed this run: ' + str(total['totalfilecount'])
+        total = newResult()
+        for modifiedepoch, files, filebytes in statedb.execute('SELECT modified, files, bytes \
+                                                                FROM keyages WHERE bucket = ? AND prefix = ?',
+                                                               (bucketname, bucketfolder)):
+            addFileAge(total, modifiedepoch, filebytes, files)
+            total['totalfilecount'] += files
+            if modifiedepoch < maxageepoch:
+                total['maxfilecount'] += files
+            if modifiedepoch > minageepoch:
+                total['minfilecount'] += files
+        statedb.close()
+
+    maxfilecount = total['maxfilecount']
+    minfilecount = total['minfilecount']
+    totalfilecount = total['totalfilecount']
+
+    #Counts are only lower bounds if the listing was stopped early
+    countprefix = ''
+    if stoplisting.is_set():
+        countprefix = '>='
+        if (args.debug):
+            print 'DEBUG: Listing stopped early, counts are lower bounds'
+
+    #Begin formatting status message for Nagios output
+    #This is conditionally formatted based on requested min/max options.
+    msg = ' -'
+    if minfileage > 0:
+        msg = msg + ' MIN:' + str(minfileage) + 'hrs'
+    if maxfileage > 0:
+        msg = msg + ' MAX:' + str(maxfileage) + 'hrs'
+
+    if maxfileage > 0:
+          msg = msg + ' - Files exceeding MAX time: ' + countprefix + str(maxfilecount)
+
+    if minfileage > 0:
+          msg = msg + ' - Files meeting MIN time: ' + countprefix + str(minfilecount)
+
+    msg = msg + ' - Total file count: ' + countprefix + str(totalfilecount)
+
+
+    #I think there probably is a better way of doing this but what I have here works.
+    #
+    # Decide exit code for Nagios based on maxfilecount and minfilecount results.
+    #
+    # maxfilecount should equal zero for green/OK
+    # minfilecount should be greater than zero for green/OK
+    #
+    if minfileage == 0 and maxfileage == 0:
+        statusline = 'WARNING: No max or min specified. Please specify at least one.' + msg
+        exitcode = 1
+    elif maxfilecount == 0 and minfilecount > 0:
+        statusline = 'OK: No S3 files exceeding time boundaries.' + msg
+        exitcode = 0
+    elif (maxfilecount > 0 or minfilecount == 0) and maxfileage > 0 and minfileage > 0:
+        statusline = 'CRITICAL: S3 files exceed time boundaries.' + msg
+        exitcode = 2
+    elif maxfilecount > 0 and maxfileage > 0 and minfileage == 0:
+        statusline = 'CRITICAL: S3 files exceed MAX time boundaries.' + msg
+        exitcode = 2
+    elif minfilecount == 0 and maxfileage == 0 and minfileage > 0:
+        statusline = 'CRITICAL: S3 files do not meet MIN time requirement.' + msg
+        exitcode = 2
+    elif minfilecount > 0 and maxfileage == 0 and minfileage > 0:
+        statusline = 'OK: S3 files meet MIN time boundaries.' + msg
+        exitcode = 0
+    elif maxfilecount == 0 and maxfileage > 0 and minfileage == 0:
+        statusline = 'OK: S3 files meet MAX time boundaries.' + msg
+        exitcode = 0
+    else:
+        statusline = 'UNKNOWN: ' + msg
+        exitcode = 3
+
+    #Build perfdata output. The newest and oldest ages carry the MIN and
+    #MAX boundaries (in seconds) as their critical values.
+    perfdata = 'object_count=' + str(totalfilecount) + ';;;0 '
+    perfdata += 'total_bytes=' + str(total['totalbytes']) + 'B;;;0 '
+    if total['newest'] is not None:
+        mincrit = ''
+        if minfileage > 0:
+            mincrit = str(minfileage * 3600)
+        maxcrit = ''
+        if maxfileage > 0:
+            maxcrit = str(maxfileage * 3600)
+        perfdata += 'newest_age=' + '%d' % (nowepoch - total['newest']) + 's;;' + mincrit + ';0 '
+        perfdata += 'oldest_age=' + '%d' % (nowepoch - total['oldest']) + 's;;' + maxcrit + ';0 '
+        perfdata += 'p50_age=' + '%d' % agePercentile(total, 50) + 's;;;0 '
+        perfdata += 'p95_age=' + '%d' % agePercentile(total, 95) + 's;;;0 '
+
+    return CheckResult(exitcode, statusline, perfdata, '')
+
+
+if __name__ == '__main__':
+    result = main()
+    output = result.message
+    if result.perfdata is not None:
+        output += '|' + result.perfdata
+    if result.long_output:
+        output += '\n' + result.long_output
+    print output
+    exit(result.state)
 
@@ -13,120 +13,414 @@
 # 
 
 import sys
+import os
+import time
+import json
+import fcntl
+import tempfile
 import argparse
-import boto
-import boto.sqs
+import threading
+from collections import namedtuple
 
 def printUsage():
     print
     print "Example:    ", sys.argv[0], "--name myqueue --region us-east-1 --warn 10 --crit 20"
     print
 
-#Parse command line arguments
-parser = argparse.ArgumentParser(description='This script is a Nagios check that \
-                                    monitors the number of messages in Amazon SQS \
-                                    queues. It requires a .boto file in the user\'s \
-                                    home directroy and AWS credentials that allow \
-                                    read access to the queues that are to be monitored.')
-
-parser.add_argument('--name', dest='name', type=str, required=True,
-                        help='Name of SQS queue. This can be a wildcard match. \
-                              For example a name of blah_ would match blah_1, \
-                              blah_2, blah_foobar. To monitor a single queue, enter \
-                              the exact name of the queue.')
-                                                      
-parser.add_argument('--region', dest='region', type=str, default='us-east-1',
-                        help='AWS Region hosting the SQS queue. \
-                              Default is us-east-1.')
-                                                      
-parser.add_argument('--warn', dest='warn', type=int, required=True, 
-                        help='Warning level for queue depth.')
-
-parser.add_argument('--crit', dest='crit', type=int, required=True, 
-                        help='Critical level for queue depth.')
-
-parser.add_argument('--debug', action='store_true', help='Enable debug output.')
-
-args = parser.parse_args()
-
-# Assign command line args to variable names
-queueName = args.name
-sqsRegion = args.region
-warnDepth = args.warn
-critDepth = args.crit
-
-if critDepth <= warnDepth:
-    print
-    print "ERROR: Critical value must be larger than warning value."
-    printUsage()
-    exit(2)
-
-
-qList = []
-depthList = []
-statusMsgList = []
-statusMsg = ""
-msgLine = ""
-perfdataMsg = ""
-warnCount = 0
-critCount = 0
-exitCode = 3 
-
-# Make SQS connection
-conn = boto.sqs.connect_to_region(sqsRegion)
-rs = conn.get_all_queues(prefix=queueName)
-
-# Loop through each queue and get message count
-# Push the queue name and depth to lists
-for qname in rs:
-    namelist = str(qname.id).split("/") # Split out queue name 
-    qList.append(namelist[2])
-    depthList.append(int(qname.count()))
-
-if args.debug:
-    print
-    print '========== Queue List ============='
-    print qList
-    print '=================================='
-    print
+#Result of a check. state is the Nagios exit code and message the status
+#line. perfdata is None when there is no perfdata and long_output holds
+#any lines that go after the first.
+CheckResult = namedtuple('CheckResult', ['state', 'message', 'perfdata', 'long_output'])
+
+#The check runs in main() so it can also be imported and run in-process.
+#It returns a CheckResult. Bad arguments and a few fatal errors print a
+#message and exit instead.
+def main(argv=None):
+
+    #Parse command line arguments
+    parser = argparse.ArgumentParser(description='This script is a Nagios check that \
+                                        monitors the number of messages in Amazon SQS \
+                                        queues. It requires a .boto file in the user\'s \
+                                        home directroy and AWS credentials that allow \
+                                        read access to the queues that are to be monitored.')
+
+    parser.add_argument('--name', dest='name', type=str, required=True,
+                            help='Name of SQS queue. This can be a wildcard match. \
+                                  For example a name of blah_ would match blah_1, \
+                                  blah_2, blah_foobar. To monitor a single queue, enter \
+                                  the exact name of the queue.')
+
+    parser.add_argument('--region', dest='region', type=str, default='us-east-1',
+                            help='AWS Region hosting the SQS queue. \
+                                  Default is us-east-1.')
+
+    parser.add_argument('--warn', dest='warn', type=int, required=True, 
+                            help='Warning level for queue depth.')
+
+    parser.add_argument('--crit', dest='crit', type=int, required=True, 
+                            help='Critical level for queue depth.')
+
+    parser.add_argument('--warninflight', dest='warninflight', type=int, default=None,
+                            help='Warning level for in flight (received but not \
+                                  deleted) messages (optional).')
+
+    parser.add_argument('--critinflight', dest='critinflight', type=int, default=None,
+                            help='Critical level for in flight messages (optional).')
+
+    parser.add_argument('--warndelayed', dest='warndelayed', type=int, default=None,
+                            help='Warning level for delayed messages (optional).')
+
+    parser.add_argument('--critdelayed', dest='critdelayed', type=int, default=None,
+                            help='Critical level for delayed messages (optional).')
+
+    parser.add_argument('--statefile', dest='statefile', type=str, default='',
+                            help='File used to keep recent queue depths between runs \
+                                  (optional). Needed for the growth rate and drain \
+                                  time checks.')
+
+    parser.add_argument('--samples', dest='samples', type=int, default=10,
+                            help='Number of recent queue depths kept per queue in \
+                                  --statefile. Default is 10.')
+
+    parser.add_argument('--warnrate', dest='warnrate', type=float, default=None,
+                            help='Warning level for queue growth in messages per \
+                                  second (optional, needs --statefile).')
+
+    parser.add_argument('--critrate', dest='critrate', type=float, default=None,
+                            help='Critical level for queue growth in messages per \
+                                  second (optional, needs --statefile).')
+
+    parser.add_argument('--warndrain', dest='warndrain', type=int, default=None,
+                            help='Warning level for the estimated seconds until the \
+                                  queue is empty (optional, needs --statefile). Only \
+                                  queues that are shrinking have a drain time, use \
+                                  --warnrate and --critrate to alert on growth.')
+
+    parser.add_argument('--critdrain', dest='critdrain', type=int, default=None,
+                            help='Critical level for the estimated seconds until the \
+                                  queue is empty (optional, needs --statefile).')
+
+    parser.add_argument('--threads', dest='threads', type=int, default=10,
+                            help='Number of queues to fetch attributes for in \
+                                  parallel. Default is 10.')
+
+    parser.add_argument('--cachefile', dest='cachefile', type=str, default='',
+                            help='File used to cache the list of queue URLs that \
+                                  match --name (optional). Cached URLs are reused \
+                                  until they expire or a queue can\'t be read.')
+
+    parser.add_argument('--cachettl', dest='cachettl', type=int, default=3600,
+                            help='Seconds before the cached queue list is refreshed. \
+                                  Default is 3600.')
+
+    parser.add_argument('--refresh', action='store_true',
+                            help='Ignore the cached queue list and look up the queues again.')
+
+    parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+    args = parser.parse_args(argv)
+
+    # Assign command line args to variable names
+    queueName = args.name
+    sqsRegion = args.region
+    warnDepth = args.warn
+    critDepth = args.crit
+    numThreads = args.threads
+    cacheFile = args.cachefile
+    cacheTTL = args.cachettl
+    cacheKey = sqsRegion + '|' + queueName
+    stateFile = args.statefile
+    numSamples = args.samples
+
+    if critDepth <= warnDepth:
+        print
+        print "ERROR: Critical value must be larger than warning value."
+        printUsage()
+        exit(2)
+
+    # In flight and delayed counts come from the same GetQueueAttributes
+    # call as the queue depth. Growth rate and drain time are worked out
+    # from the depths kept in the state file. Their thresholds are optional.
+    extraChecks = [['in_flight', args.warninflight, args.critinflight, ''],
+                   ['delayed', args.warndelayed, args.critdelayed, ''],
+                   ['rate', args.warnrate, args.critrate, ''],
+                   ['drain', args.warndrain, args.critdrain, 's']]
+
+    for label, warnLevel, critLevel, uom in extraChecks:
+        if warnLevel is not None and critLevel is not None and critLevel <= warnLevel:
+            print
+            print "ERROR: Critical " + label + " value must be larger than warning value."
+            printUsage()
+            exit(2)
+
+    if not stateFile and (args.warnrate is not None or args.critrate is not None \
+                          or args.warndrain is not None or args.critdrain is not None):
+        print
+        print "ERROR: Rate and drain thresholds need a --statefile."
+        printUsage()
+        exit(2)
+
+    if numSamples < 2:
+        print
+        print "ERROR: At least 2 samples are needed to work out a rate."
+        printUsage()
+        exit(2)
+
+    if numThreads < 1:
+        print
+        print "ERROR: Number of threads must be at least 1."
+        printUsage()
+        exit(2)
+
+    # boto is slow to import so it is only loaded once the
+    # arguments are known to be good.
+    import boto.sqs
+    from boto.sqs.queue import Queue
+    from boto.exception import BotoServerError
+
+    qList = []
+    depthList = []
+    inFlightList = []
+    delayedList = []
+    statusMsgList = []
+    statusMsg = ""
+    msgLine = ""
+    perfdataMsg = ""
+    warnCount = 0
+    critCount = 0
+    exitCode = 3 
+
+    # boto connections should not be shared between threads so
+    # each worker thread makes its own SQS connection.
+    threadData = threading.local()
+
+    def getConnection():
+        if not hasattr(threadData, 'conn'):
+            threadData.conn = boto.sqs.connect_to_region(sqsRegion)
+        return threadData.conn
+
+    # A single GetQueueAttributes call returns the visible, in flight
+    # and delayed message counts for a queue together.
+    def getQueueDepths(queueUrl):
+        conn = getConnection()
+        attributes = conn.get_queue_attributes(Queue(conn, queueUrl), 'All')
+        return [int(attributes.get('ApproximateNumberOfMessages', 0)),
+                int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0)),
+                int(attributes.get('ApproximateNumberOfMessagesDelayed', 0))]
+
+    # Look up the URLs of the queues matching the name prefix
+    def findQueues():
+        return [q.url for q in getConnection().get_all_queues(prefix=queueName)]
+
+    # Cache and state files are shared by every check that uses them,
+    # including checks running at the same time in other processes or in
+    # check_runner.py threads. Each update holds a lock on the file while
+    # it is read, changed and written back so no run's changes are lost,
+    # and the new file is written to a unique temp file and renamed into
+    # place so readers never see a partial write.
+    def loadJsonFile(fileName):
+        try:
+            with open(fileName) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def updateJsonFile(fileName, update):
+        with open(fileName + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            data = loadJsonFile(fileName)
+            update(data)
+            fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(fileName) or '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.rename(tmpFile, fileName)
+            except Exception:
+                os.unlink(tmpFile)
+                raise
+        return data
+
+    # The cache file holds the queue URLs for each region and name prefix
+    # along with the time they were looked up.
+    def loadCache():
+        return loadJsonFile(cacheFile)
+
+    def saveCache(queueUrls):
+        def update(cache):
+            cache[cacheKey] = {'time': time.time(), 'urls': queueUrls}
+        updateJsonFile(cacheFile, update)
+
+    # Growth rate (messages per second) is the least squares slope through
+    # the recent [time, depth] samples for a queue. Drain time is how long
+    # the queue takes to empty at that rate. It is None when the queue is
+    # not shrinking, growth is left to the rate thresholds. Both are None
+    # until there are two samples.
+    def depthTrend(samples):
+        if len(samples) < 2:
+            return None, None
+        meanTime = sum(sample[0] for sample in samples) / len(samples)
+        meanDepth = sum(sample[1] for sample in samples) / float(len(samples))
+        timeSpread = sum((sample[0] - meanTime) ** 2 for sample in samples)
+        if timeSpread == 0:
+            return None, None
+        rate = sum((sample[0] - meanTime) * (sample[1] - meanDepth) for sample in samples) / timeSpread
+        depth = samples[-1][1]
+        if depth == 0:
+            return rate, 0
+        if rate < 0:
+            return rate, int(depth / -rate)
+        return rate, None
+
+    def getAllQueueDepths(queueUrls):
+        if not queueUrls:
+            return []
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(numThreads, len(queueUrls)))
+        try:
+            return pool.map(getQueueDepths, queueUrls)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Use the cached queue list when it is fresh, otherwise look the
+    # queues up and cache the result.
+    queueUrls = None
+    if cacheFile and not args.refresh:
+        cached = loadCache().get(cacheKey)
+        if cached and cached['urls'] and time.time() - cached['time'] < cacheTTL:
+            queueUrls = cached['urls']
+            if args.debug:
+                print 'Using cached queue list from ' + cacheFile
+    usedCache = queueUrls is not None
+    if not usedCache:
+        queueUrls = findQueues()
+        if cacheFile:
+            saveCache(queueUrls)
+
+    # Get message counts for the queues in parallel. The results come
+    # back in the same order as the queue list. If a cached queue can't
+    # be read (it may have been deleted) refresh the list and try again.
+    try:
+        queueDepths = getAllQueueDepths(queueUrls)
+    except BotoServerError:
+        if not usedCache:
+            raise
+        if args.debug:
+            print 'Reading a cached queue failed, refreshing the queue list'
+        queueUrls = findQueues()
+        saveCache(queueUrls)
+        queueDepths = getAllQueueDepths(queueUrls)
+
+    for index in range(len(queueUrls)):
+        qList.append(str(queueUrls[index]).rsplit('/', 1)[-1]) # Queue name is the end of the URL
+        depthList.append(queueDepths[index][0])
+        inFlightList.append(queueDepths[index][1])
+        delayedList.append(queueDepths[index][2])
+
+    # Add this run's depths to the ring of recent samples for each
+    # queue and work out the growth rate and drain time.
+    rateList = [None] * len(queueUrls)
+    drainList = [None] * len(queueUrls)
+    if stateFile:
+        now = time.time()
+        def update(state):
+            for index in range(len(queueUrls)):
+                samples = state.get(queueUrls[index], []) + [[now, depthList[index]]]
+                state[queueUrls[index]] = samples[-numSamples:]
+        state = updateJsonFile(stateFile, update)
+        for index in range(len(queueUrls)):
+            rateList[index], drainList[index] = depthTrend(state[queueUrls[index]])
+
+    if args.debug:
+        print
+        print '========== Queue List ============='
+        print qList
+        print '========== In Flight / Delayed ==='
+        print inFlightList
+        print delayedList
+        print '========== Rate / Drain =========='
+        print rateList
+        print drainList
+        print '=================================='
+        print
+
+    # Rates are shown with 3 decimal places
+    def formatValue(value):
+        if isinstance(value, float):
+            return "%.3f" % value
+        return str(value)
+
+    # Build status message and check warn/crit values
+    for index in range(len(qList)):
+        if depthList[index] >= warnDepth and depthList[index] < critDepth:
+            warnCount += 1
+        if depthList[index] >= critDepth:
+            critCount += 1
+        #print index, ": ", qList[index], depthList[index]
+        msgLine = qList[index] + ":" + str(depthList[index]) 
+        extraValues = [inFlightList[index], delayedList[index], rateList[index], drainList[index]]
+        for extraIndex in range(len(extraChecks)):
+            label, warnLevel, critLevel, uom = extraChecks[extraIndex]
+            value = extraValues[extraIndex]
+            if value is None:
+                continue
+            if critLevel is not None and value >= critLevel:
+                critCount += 1
+            elif warnLevel is not None and value >= warnLevel:
+                warnCount += 1
+            if warnLevel is not None or critLevel is not None:
+                msgLine += "/" + label + ":" + formatValue(value)
+        statusMsgList.append(msgLine) 
+
+    # Set exit code based on number of warnings and criticals
+    if warnCount == 0 and critCount == 0:
+        statusMsgList.insert(0, "OK - Queue depth (")
+        exitCode = 0
+    elif warnCount > 0 and critCount == 0:
+        statusMsgList.insert(0, "WARNING - Queue depth (")
+        exitCode = 1
+    elif critCount > 0:
+        statusMsgList.insert(0, "CRITICAL - Queue depth (")
+        exitCode = 2
+    else:
+        statusMsgList.insert(0, "UNKNOWN - Queue depth (")
+        exitCode = 3
+
+    # Build status message output
+    for msg in statusMsgList:
+        statusMsg += msg + " "
+
+    # Levels for perfdata output. Unset levels are left empty.
+    def perfLevel(level):
+        if level is None:
+            return ""
+        return str(level)
+
+    # Build perfdata output
+    for index in range(len(qList)):
+        perfdataMsg += qList[index] + "=" + str(depthList[index]) + ";" + str(warnDepth) + ";" + str(critDepth) + "; "
+        extraValues = [inFlightList[index], delayedList[index], rateList[index], drainList[index]]
+        for extraIndex in range(len(extraChecks)):
+            label, warnLevel, critLevel, uom = extraChecks[extraIndex]
+            value = extraValues[extraIndex]
+            if value is None:
+                continue
+            perfdataMsg += qList[index] + "_" + label + "=" + formatValue(value) + uom + ";" \
+                           + perfLevel(warnLevel) + ";" + perfLevel(critLevel) + "; "
+
+    # Finalize status message
+    statusMsg += ") [W:" + str(warnDepth) + " C:" + str(critDepth) + "]"
+
+    # Final output for Nagios
+    return CheckResult(exitCode, statusMsg, perfdataMsg, '')
+
 
-# Build status message and check warn/crit values
-for index in range(len(qList)):
-    if depthList[index] >= warnDepth and depthList[index] < critDepth:
-        warnCount += 1
-    if depthList[index] >= critDepth:
-        critCount += 1
-    #print index, ": ", qList[index], depthList[index]
-    msgLine = qList[index] + ":" + str(depthList[index]) 
-    statusMsgList.append(msgLine) 
-
-# Set exit code based on number of warnings and criticals
-if warnCount == 0 and critCount == 0:
-    statusMsgList.insert(0, "OK - Queue depth (")
-    exitCode = 0
-elif warnCount > 0 and critCount == 0:
-    statusMsgList.insert(0, "WARNING - Queue depth (")
-    exitCode = 1
-elif critCount > 0:
-    statusMsgList.insert(0, "CRITICAL - Queue depth (")
-    exitCode = 2
-else:
-    statusMsgList.insert(0, "UNKNOWN - Queue depth (")
-    exitCode = 3
-
-# Build status message output
-for msg in statusMsgList:
-    statusMsg += msg + " "
-
-# Build perfdata output
-for index in range(len(qList)):
-    perfdataMsg += qList[index] + "=" + str(depthList[index]) + ";" + str(warnDepth) + ";" + str(critDepth) + "; "
-
-# Finalize status message
-statusMsg += ") [W:" + str(warnDepth) + " C:" + str(critDepth) + "]"
-
-# Print final output for Nagios
-print statusMsg + "|" + perfdataMsg
-
-# Exit with appropriate code
-exit(exitCode)
+if __name__ == '__main__':
+    result = main()
+    output = result.message
+    if result.perfdata is not None:
+        output += '|' + result.perfdata
+    if result.long_output:
+        output += '\n' + result.long_output
+    print output
+    exit(result.state)
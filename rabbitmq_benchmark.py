@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This script compares the wall time and CPU time of check_rabbitmq_cluster.py
+# reading the node list from the management HTTP API against forking the
+# rabbitmqadmin command, and checks that both give the same result. The
+# management API is a fake server on 127.0.0.1 that runs in a child
+# process. The real rabbitmqadmin command is used when it is installed,
+# otherwise a stand-in script that loads the same kind of modules and
+# makes the same request. The check is run in-process through its main(),
+# and the CPU time includes the rabbitmqadmin processes.
+#
+# Output is in Nagios format with one line per case after the first. It
+# exits CRITICAL when the results differ and WARNING when the HTTP API is
+# less than --minspeedup times faster than rabbitmqadmin.
+#
+
+import sys
+import os
+import time
+import argparse
+import imp
+import json
+import shutil
+import tempfile
+import multiprocessing
+import BaseHTTPServer
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--nodes 5 --runs 200"
+    print
+
+#Parse command line arguments
+parser = argparse.ArgumentParser(description='This script compares the HTTP API and \
+                                    rabbitmqadmin paths of check_rabbitmq_cluster.py.')
+
+parser.add_argument('--nodes', dest='nodes', type=int, default=3,
+                        help='Nodes in the fake cluster. Default is 3.')
+
+parser.add_argument('--runs', dest='runs', type=int, default=50,
+                        help='Times to run each case. Times are averaged. Default is 50.')
+
+parser.add_argument('--rabbitmqadmin', dest='rabbitmqadmin', type=str, default='',
+                        help='rabbitmqadmin command to compare against. Default is \
+                              /usr/local/bin/rabbitmqadmin when it is installed, \
+                              otherwise a stand-in script.')
+
+parser.add_argument('--minspeedup', dest='minspeedup', type=float, default=2,
+                        help='Warn when the HTTP API is less than this many times \
+                              faster than rabbitmqadmin. Default is 2.')
+
+parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+args = parser.parse_args()
+
+if args.nodes < 1 or args.runs < 1:
+    print
+    print "ERROR: --nodes and --runs must be at least 1."
+    printUsage()
+    exit(2)
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+check = imp.load_source('check_rabbitmq_cluster', os.path.join(scriptDir, 'check_rabbitmq_cluster.py'))
+
+
+##################################################
+# Fake management API. /api/nodes lists --nodes
+# running nodes, any query string is ignored.
+nodeList = [{'name': 'rabbit@node%d' % index, 'running': True,
+             'mem_used': 400000000 + index, 'mem_limit': 1600000000,
+             'fd_used': 120 + index, 'fd_total': 65536,
+             'sockets_used': 80 + index, 'sockets_total': 58890,
+             'proc_used': 900 + index, 'proc_total': 1048576,
+             'disk_free': 40000000000, 'disk_free_limit': 50000000,
+             'partitions': []}
+            for index in range(args.nodes)]
+
+
+class ManagementHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Answers go out in one write so delayed ACKs
+    # don't add to the latency
+    wbufsize = -1
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/api/nodes':
+            self.send_error(404)
+            return
+        body = json.dumps(nodeList)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *logArgs):
+        pass
+
+server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ManagementHandler)
+serverHost, serverPort = server.server_address
+serverProcess = multiprocessing.Process(target=server.serve_forever)
+serverProcess.daemon = True
+serverProcess.start()
+server.socket.close()
+
+# Stand-in for rabbitmqadmin list nodes --format=raw_json.
+# Like the real command it is a Python script that
+# parses its options, loads the HTTP modules and makes
+# one request to the management API.
+fakeRabbitmqadmin = '''#!%s
+import sys
+import optparse
+import httplib
+import urllib
+import base64
+import json
+import socket
+import ssl
+
+parser = optparse.OptionParser()
+parser.add_option('--host', default='localhost')
+parser.add_option('--port', type='int', default=15672)
+parser.add_option('--username', default='guest')
+parser.add_option('--password', default='guest')
+parser.add_option('--format', default='table')
+parser.add_option('--ssl', action='store_true')
+options, listArgs = parser.parse_args()
+conn = httplib.HTTPConnection(options.host, options.port)
+credentials = base64.b64encode(options.username + ':' + options.password)
+conn.request('GET', '/api/' + urllib.quote(listArgs[1]),
+             headers={'Authorization': 'Basic ' + credentials})
+response = conn.getresponse()
+if response.status != 200:
+    sys.exit('HTTP ' + str(response.status))
+print json.dumps(json.loads(response.read()))
+''' % sys.executable
+
+tempDir = tempfile.mkdtemp()
+rabbitmqadminCmd = args.rabbitmqadmin
+if not rabbitmqadminCmd and os.path.exists(check.rabbitmqadminCmd):
+    rabbitmqadminCmd = check.rabbitmqadminCmd
+if not rabbitmqadminCmd:
+    rabbitmqadminCmd = os.path.join(tempDir, 'rabbitmqadmin')
+    with open(rabbitmqadminCmd, 'w') as f:
+        f.write(fakeRabbitmqadmin)
+    os.chmod(rabbitmqadminCmd, 0755)
+check.rabbitmqadminCmd = rabbitmqadminCmd
+if args.debug:
+    print 'Using ' + rabbitmqadminCmd + ' against port ' + str(serverPort)
+
+
+##################################################
+# Each case is a name and the extra check arguments.
+# CPU time counts this process and the rabbitmqadmin
+# processes it waited for, not the fake server.
+checkArgs = ['--host', serverHost, '--port', str(serverPort), '--minnodes', str(args.nodes)]
+benchmarkCases = [
+    ['http', []],
+    ['rabbitmqadmin', ['--rabbitmqadmin']],
+]
+
+caseTimes = {}
+caseResults = {}
+try:
+    for name, caseArgs in benchmarkCases:
+        # The first run loads the network modules and isn't counted
+        check.main(checkArgs + caseArgs)
+        startTimes = os.times()
+        start = time.time()
+        for run in range(args.runs):
+            caseResults[name] = check.main(checkArgs + caseArgs)
+        wallTime = (time.time() - start) / args.runs
+        endTimes = os.times()
+        cpuTime = sum(endTimes[0:4]) - sum(startTimes[0:4])
+        caseTimes[name] = (wallTime, cpuTime / args.runs)
+        if args.debug:
+            print name + ': ' + str(caseResults[name])
+finally:
+    serverProcess.terminate()
+    shutil.rmtree(tempDir)
+
+speedup = caseTimes['rabbitmqadmin'][0] / caseTimes['http'][0]
+cpuRatio = caseTimes['rabbitmqadmin'][1] / max(caseTimes['http'][1], 0.0001)
+
+caseLines = []
+perfdataMsg = ''
+for name, caseArgs in benchmarkCases:
+    wallTime, cpuTime = caseTimes[name]
+    caseLines.append('%s: %.1fms wall, %.1fms cpu per check - %s'
+                     % (name, wallTime * 1000, cpuTime * 1000, caseResults[name].message))
+    perfdataMsg += '%s=%.2fms;;;0; %s_cpu=%.2fms;;;0; ' % (name, wallTime * 1000, name, cpuTime * 1000)
+perfdataMsg += 'speedup=%.2f;%g;;0; ' % (speedup, args.minspeedup)
+
+if caseResults['http'] != caseResults['rabbitmqadmin']:
+    exitCode = 2
+    statusMsg = 'CRITICAL - HTTP API and rabbitmqadmin results differ'
+elif speedup < args.minspeedup:
+    exitCode = 1
+    statusMsg = 'WARNING - HTTP API only %.1fx faster than rabbitmqadmin' % speedup
+else:
+    exitCode = 0
+    statusMsg = 'OK - HTTP API %.1fx faster and %.1fx less CPU than rabbitmqadmin, results match' \
+                % (speedup, cpuRatio)
+
+print statusMsg + '|' + perfdataMsg
+print '\n'.join(caseLines)
+exit(exitCode)
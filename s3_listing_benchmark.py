@@ -0,0 +1,256 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This script measures how long check_s3_file_age.py takes to list a
+# large bucket in its serial, --sharddelimiter and --statefile modes and
+# checks that they all count the same files. It also times --fast, which
+# should stop after the first page, and checks it gives the right state
+# with its counts marked as lower bounds. No S3 access is needed.
+# boto.connect_s3 is replaced with an in-memory bucket of --keys files
+# spread over --shards folders, and every page of 1000 results sleeps for
+# --pagelatency milliseconds like a ListObjects call would. The check is
+# run in-process through its main().
+#
+# Output is in Nagios format with one line per case after the first. It
+# exits CRITICAL when the counts or a --fast state are wrong and WARNING
+# when sharding is less than --minspeedup times faster than a serial
+# listing.
+#
+
+import sys
+import os
+import time
+import argparse
+import bisect
+import random
+import re
+import imp
+import shutil
+import tempfile
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--keys 200000 --pagelatency 20"
+    print
+
+#Parse command line arguments
+parser = argparse.ArgumentParser(description='This script measures the listing modes \
+                                    of check_s3_file_age.py against a fake bucket.')
+
+parser.add_argument('--keys', dest='keys', type=int, default=1000000,
+                        help='Files in the fake bucket. Default is 1000000.')
+
+parser.add_argument('--shards', dest='shards', type=int, default=16,
+                        help='Folders the files are spread over. Default is 16.')
+
+parser.add_argument('--pagelatency', dest='pagelatency', type=float, default=30,
+                        help='Milliseconds each page of 1000 results takes. Default is 30.')
+
+parser.add_argument('--threads', dest='threads', type=int, default=8,
+                        help='Threads for the sharded listing. Default is 8.')
+
+parser.add_argument('--runs', dest='runs', type=int, default=1,
+                        help='Times to run each case. The best time is used. Default is 1.')
+
+parser.add_argument('--minspeedup', dest='minspeedup', type=float, default=2,
+                        help='Warn when the sharded listing is less than this many times \
+                              faster than the serial one. Default is 2.')
+
+parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+args = parser.parse_args()
+
+if args.keys < 1 or args.shards < 1 or args.threads < 1 or args.runs < 1 or args.pagelatency < 0:
+    print
+    print "ERROR: --keys, --shards, --threads and --runs must be at least 1 and --pagelatency 0 or more."
+    printUsage()
+    exit(2)
+
+import boto
+from boto.s3.prefix import Prefix
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+check = imp.load_source('check_s3_file_age', os.path.join(scriptDir, 'check_s3_file_age.py'))
+
+pageSize = 1000
+bucketFolder = 'backups/'
+
+
+##################################################
+# Fake bucket. Keys are kept sorted by name so a
+# listing can start at its prefix or marker with a
+# bisect, and a delimiter listing can jump over each
+# folder it returns as a Prefix.
+class FakeKey(object):
+    __slots__ = ['name', 'last_modified', 'storage_class', 'size']
+
+    def __init__(self, name, last_modified, size):
+        self.name = name
+        self.last_modified = last_modified
+        self.storage_class = 'STANDARD'
+        self.size = size
+
+
+class FakeBucket(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.names = [key.name for key in keys]
+
+    def list(self, prefix='', delimiter='', marker=''):
+        index = max(bisect.bisect_left(self.names, prefix),
+                    bisect.bisect_right(self.names, marker))
+        returned = 0
+        time.sleep(args.pagelatency / 1000.0)
+        while index < len(self.names) and self.names[index].startswith(prefix):
+            if returned and returned % pageSize == 0:
+                time.sleep(args.pagelatency / 1000.0)
+            returned += 1
+            key = self.keys[index]
+            if delimiter:
+                folderEnd = key.name.find(delimiter, len(prefix))
+                if folderEnd >= 0:
+                    folder = key.name[:folderEnd + len(delimiter)]
+                    yield Prefix(name=folder)
+                    index = bisect.bisect_left(self.names, folder + '\xff', index)
+                    continue
+            yield key
+            index += 1
+
+
+class FakeConnection(object):
+    def lookup(self, bucketname):
+        return fakeBucket
+
+    def get_bucket(self, bucketname, validate=True):
+        return fakeBucket
+
+
+# Files are up to three days old with a few directly
+# under the bucket folder next to the shard folders.
+# Ages stay ten minutes clear of whole hours so no
+# file crosses the MIN or MAX age during a benchmark.
+def makeKeys():
+    random.seed(1)
+    nowEpoch = int(time.time())
+    lastModified = {}
+    keys = []
+    for i in range(args.keys):
+        if i < args.shards:
+            name = bucketFolder + 'manifest-%04d.json' % i
+        else:
+            name = bucketFolder + '%04d/file%09d.tar.gz' % (i * args.shards // args.keys, i)
+        age = random.randint(0, 71) * 3600 + random.randint(600, 3000)
+        if age not in lastModified:
+            lastModified[age] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(nowEpoch - age))
+        keys.append(FakeKey(name, lastModified[age], random.randint(1, 1 << 20)))
+    keys.sort(key=lambda key: key.name)
+    return keys
+
+start = time.time()
+fakeBucket = FakeBucket(makeKeys())
+boto.connect_s3 = lambda *connectArgs, **connectKwargs: FakeConnection()
+if args.debug:
+    print 'Made %d keys in %.1fs' % (args.keys, time.time() - start)
+
+
+# Run the check once and return its wall and CPU
+# time in seconds and what it counted. The ages in
+# the perfdata move with the clock so only the
+# status, the counts and the bytes are compared.
+def runCheck(checkArgs):
+    cpuStart = sum(os.times()[0:2])
+    start = time.time()
+    result = check.main(checkArgs)
+    wallTime = time.time() - start
+    cpuTime = sum(os.times()[0:2]) - cpuStart
+    counts = (result.state, result.message,
+              re.search(r'object_count=(\d+)', result.perfdata).group(1),
+              re.search(r'total_bytes=(\d+)', result.perfdata).group(1))
+    if args.debug:
+        print ' '.join(checkArgs) + ': %.2fs' % wallTime
+        print result.message + '|' + result.perfdata
+    return wallTime, cpuTime, counts
+
+stateDir = tempfile.mkdtemp()
+stateFile = os.path.join(stateDir, 'state.db')
+checkArgs = ['--bucketname', 'benchmark', '--bucketfolder', bucketFolder,
+             '--minfileage', '24', '--maxfileage', '48']
+
+##################################################
+# Each case is a name, the check arguments and the
+# state a --fast case must give, or None when its
+# counts must match the serial listing. The bucket
+# always has files older than MAX and newer than
+# MIN, so with MAX set --fast stops at the first old
+# file and with only MIN set at the first new one.
+# The statefile cases run one after the other, first
+# with an empty state file and then incrementally
+# from what the first run saved.
+benchmarkCases = [
+    ['serial', checkArgs, None],
+    ['sharded', checkArgs + ['--sharddelimiter', '/', '--threads', str(args.threads)], None],
+    ['statefile_full', checkArgs + ['--statefile', stateFile], None],
+    ['statefile_incremental', checkArgs + ['--statefile', stateFile], None],
+    ['fast', checkArgs + ['--fast'], 2],
+    ['fast_minonly', ['--bucketname', 'benchmark', '--bucketfolder', bucketFolder,
+                      '--minfileage', '24', '--fast'], 0],
+]
+
+caseTimes = {}
+caseCounts = {}
+try:
+    for run in range(args.runs):
+        if os.path.exists(stateFile):
+            os.remove(stateFile)
+        for name, caseArgs, fastState in benchmarkCases:
+            wallTime, cpuTime, counts = runCheck(caseArgs)
+            if name not in caseTimes or wallTime < caseTimes[name][0]:
+                caseTimes[name] = (wallTime, cpuTime)
+            caseCounts[name] = counts
+finally:
+    shutil.rmtree(stateDir)
+
+speedup = caseTimes['serial'][0] / caseTimes['sharded'][0]
+mismatched = []
+for name, caseArgs, fastState in benchmarkCases:
+    if fastState is None:
+        if caseCounts[name] != caseCounts['serial']:
+            mismatched.append(name)
+    elif caseCounts[name][0] != fastState or '>=' not in caseCounts[name][1]:
+        mismatched.append(name)
+if caseCounts['serial'][2] != str(args.keys):
+    mismatched.insert(0, 'serial')
+
+caseLines = []
+perfdataMsg = ''
+for name, caseArgs, fastState in benchmarkCases:
+    wallTime, cpuTime = caseTimes[name]
+    caseLines.append('%s: %.2fs wall, %.2fs cpu - object_count=%s total_bytes=%s - %s'
+                     % (name, wallTime, cpuTime, caseCounts[name][2], caseCounts[name][3],
+                        caseCounts[name][1].strip(' -')))
+    perfdataMsg += '%s=%.3fs;;;0; ' % (name, wallTime)
+perfdataMsg += 'speedup=%.2f;%g;;0; ' % (speedup, args.minspeedup)
+
+if mismatched:
+    exitCode = 2
+    statusMsg = 'CRITICAL - wrong results listing ' + str(args.keys) \
+                + ' files: ' + ', '.join(mismatched)
+elif speedup < args.minspeedup:
+    exitCode = 1
+    statusMsg = 'WARNING - sharded listing only %.1fx faster than serial' % speedup
+else:
+    exitCode = 0
+    statusMsg = 'OK - sharded listing %.1fx and --fast %.0fx faster than serial, results match' \
+                % (speedup, caseTimes['serial'][0] / caseTimes['fast'][0])
+
+print statusMsg + '|' + perfdataMsg
+print '\n'.join(caseLines)
+exit(exitCode)
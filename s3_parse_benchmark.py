@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This script compares how fast check_s3_file_age.py evaluates the
+# LastModified time of each key with parseLastModified against the
+# dateutil path it used before, and checks that both give the same
+# results. The old key loop parsed each timestamp with dateutil once for
+# the MAX comparison and again for the MIN one, and once more for the
+# --listfiles line. The same work is timed here for --keys synthetic
+# timestamps, with parseLastModified and formatLastModified taken from
+# the check itself.
+#
+# Output is in Nagios format with one line per case after the first. It
+# exits CRITICAL when any timestamp gives a different result and WARNING
+# when the key evaluation is less than --minspeedup times faster.
+#
+
+import sys
+import os
+import time
+import argparse
+import random
+import imp
+import datetime
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--keys 200000 --runs 5"
+    print
+
+#Parse command line arguments
+parser = argparse.ArgumentParser(description='This script compares the LastModified \
+                                    parsing in check_s3_file_age.py with dateutil.')
+
+parser.add_argument('--keys', dest='keys', type=int, default=20000,
+                        help='Timestamps to parse. Default is 20000.')
+
+parser.add_argument('--runs', dest='runs', type=int, default=3,
+                        help='Times to run each case. The best time is used. Default is 3.')
+
+parser.add_argument('--minspeedup', dest='minspeedup', type=float, default=10,
+                        help='Warn when the key evaluation is less than this many times \
+                              faster than dateutil. Default is 10.')
+
+parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+args = parser.parse_args()
+
+if args.keys < 1 or args.runs < 1:
+    print
+    print "ERROR: --keys and --runs must be at least 1."
+    printUsage()
+    exit(2)
+
+import dateutil.parser
+from dateutil.tz import tzutc
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+check = imp.load_source('check_s3_file_age', os.path.join(scriptDir, 'check_s3_file_age.py'))
+
+# Timestamps from the last three days in the format
+# of a bucket listing. Most have whole seconds like
+# real listings, the rest have milliseconds so both
+# branches of formatLastModified are covered.
+random.seed(1)
+nowEpoch = time.time()
+timestamps = []
+for i in range(args.keys):
+    modified = datetime.datetime.utcfromtimestamp(int(nowEpoch) - random.randint(0, 72 * 3600))
+    millis = 0
+    if i % 4 == 0:
+        millis = random.randint(1, 999)
+    timestamps.append(modified.strftime('%Y-%m-%dT%H:%M:%S') + '.%03dZ' % millis)
+
+maxagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=48)
+minagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=24)
+maxageepoch = check.toEpoch(maxagetime)
+minageepoch = check.toEpoch(minagetime)
+
+
+##################################################
+# Each pair of functions does the same work for
+# every timestamp, the old way and the new way, and
+# returns how many were older than MAX and newer
+# than MIN or the --listfiles strings.
+def evaluateOld(timestamps):
+    maxfilecount = 0
+    minfilecount = 0
+    for lastmodified in timestamps:
+        if dateutil.parser.parse(lastmodified) < maxagetime:
+            maxfilecount += 1
+        if dateutil.parser.parse(lastmodified) > minagetime:
+            minfilecount += 1
+    return maxfilecount, minfilecount
+
+def evaluateNew(timestamps):
+    maxfilecount = 0
+    minfilecount = 0
+    for lastmodified in timestamps:
+        modifiedepoch = check.parseLastModified(lastmodified)
+        if modifiedepoch < maxageepoch:
+            maxfilecount += 1
+        if modifiedepoch > minageepoch:
+            minfilecount += 1
+    return maxfilecount, minfilecount
+
+def listfilesOld(timestamps):
+    return [str(dateutil.parser.parse(lastmodified).replace(tzinfo=tzutc()))
+            for lastmodified in timestamps]
+
+def listfilesNew(timestamps):
+    return [check.formatLastModified(lastmodified) for lastmodified in timestamps]
+
+benchmarkCases = [
+    ['evaluate', evaluateOld, evaluateNew],
+    ['listfiles', listfilesOld, listfilesNew],
+]
+
+
+# Best wall time in seconds of --runs calls and
+# the result of the last one
+def timeRuns(function):
+    best = None
+    for run in range(args.runs):
+        start = time.time()
+        result = function(timestamps)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+mismatched = []
+caseLines = []
+perfdataMsg = ''
+speedups = {}
+for name, oldFunction, newFunction in benchmarkCases:
+    oldTime, oldResult = timeRuns(oldFunction)
+    newTime, newResult = timeRuns(newFunction)
+    if oldResult != newResult:
+        mismatched.append(name)
+    speedups[name] = oldTime / newTime
+    if args.debug:
+        print name + ': old ' + str(oldResult)[:200]
+        print name + ': new ' + str(newResult)[:200]
+    caseLines.append('%s: dateutil %.0f keys/s, new %.0f keys/s, %.1fx faster'
+                     % (name, args.keys / oldTime, args.keys / newTime, speedups[name]))
+    perfdataMsg += '%s_dateutil=%.0f;;;0; %s_new=%.0f;;;0; ' \
+                   % (name, args.keys / oldTime, name, args.keys / newTime)
+
+#The epoch values themselves must match too, not just the counts
+for lastmodified in timestamps:
+    if abs(check.parseLastModified(lastmodified)
+           - check.toEpoch(dateutil.parser.parse(lastmodified))) > 0.000001:
+        mismatched.append('epoch of ' + lastmodified)
+        break
+
+if mismatched:
+    exitCode = 2
+    statusMsg = 'CRITICAL - results differ from dateutil: ' + ', '.join(mismatched)
+elif speedups['evaluate'] < args.minspeedup:
+    exitCode = 1
+    statusMsg = 'WARNING - key evaluation only %.1fx faster than dateutil' % speedups['evaluate']
+else:
+    exitCode = 0
+    statusMsg = 'OK - key evaluation %.1fx faster than dateutil, %d timestamps match' \
+                % (speedups['evaluate'], args.keys)
+
+print statusMsg + '|' + perfdataMsg
+print '\n'.join(caseLines)
+exit(exitCode)
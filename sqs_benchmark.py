@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This script compares how long check_sqs_depth.py takes to read many
+# queues with its pool of GetQueueAttributes calls against the serial
+# Queue.count() loop it used before, and checks both read the same
+# depths. The queues are served by a mock SQS endpoint on 127.0.0.1 that
+# runs in a child process and waits --latency milliseconds before each
+# answer. Both paths talk to it through boto as they would to AWS, the
+# check is run in-process through its main().
+#
+# Output is in Nagios format with one line per case after the first. It
+# exits CRITICAL when the depths don't match and WARNING when the pool
+# is less than --minspeedup times faster than the serial loop.
+#
+
+import sys
+import os
+import time
+import argparse
+import re
+import imp
+import urlparse
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--queues 500 --latency 30"
+    print
+
+#Parse command line arguments
+parser = argparse.ArgumentParser(description='This script compares the queue reads \
+                                    of check_sqs_depth.py with a serial count() loop.')
+
+parser.add_argument('--queues', dest='queues', type=int, default=300,
+                        help='Queues on the mock endpoint. Default is 300.')
+
+parser.add_argument('--latency', dest='latency', type=float, default=20,
+                        help='Milliseconds the mock endpoint waits before each \
+                              answer. Default is 20.')
+
+parser.add_argument('--threads', dest='threads', type=int, default=10,
+                        help='--threads for the check. Default is 10.')
+
+parser.add_argument('--runs', dest='runs', type=int, default=3,
+                        help='Times to run each case. The best time is used. Default is 3.')
+
+parser.add_argument('--minspeedup', dest='minspeedup', type=float, default=3,
+                        help='Warn when the pool is less than this many times faster \
+                              than the serial loop. Default is 3.')
+
+parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+args = parser.parse_args()
+
+if args.queues < 1 or args.threads < 1 or args.runs < 1 or args.latency < 0:
+    print
+    print "ERROR: --queues, --threads and --runs must be at least 1 and --latency 0 or more."
+    printUsage()
+    exit(2)
+
+import boto.sqs
+from boto.sqs.connection import SQSConnection
+from boto.regioninfo import RegionInfo
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+check = imp.load_source('check_sqs_depth', os.path.join(scriptDir, 'check_sqs_depth.py'))
+
+queuePrefix = 'benchmark_'
+sqsNamespace = 'http://queue.amazonaws.com/doc/2012-11-05/'
+
+
+##################################################
+# Mock SQS endpoint. It answers ListQueues and
+# GetQueueAttributes for --queues queues named
+# benchmark_0000 and up. Each queue has its own
+# visible, in flight and delayed counts.
+def queueAttributes(queueName):
+    index = int(queueName[len(queuePrefix):])
+    return [['ApproximateNumberOfMessages', index % 97],
+            ['ApproximateNumberOfMessagesNotVisible', index % 13],
+            ['ApproximateNumberOfMessagesDelayed', index % 5],
+            ['VisibilityTimeout', 30],
+            ['MessageRetentionPeriod', 345600]]
+
+
+class MockSQSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Answers go out in one write so delayed ACKs
+    # don't add to the latency
+    wbufsize = -1
+
+    # boto sends ListQueues as a GET and queue actions as a
+    # POST, both with the parameters in the form encoding.
+    def do_GET(self):
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        self.answer(path, dict(urlparse.parse_qsl(query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.answer(urlparse.urlsplit(self.path)[2], dict(urlparse.parse_qsl(body)))
+
+    def answer(self, path, params):
+        time.sleep(args.latency / 1000.0)
+        action = params.get('Action')
+        if action == 'ListQueues':
+            prefix = params.get('QueueNamePrefix', '')
+            result = ''.join('<QueueUrl>http://%s:%d/123456789012/%s%04d</QueueUrl>'
+                             % (serverHost, serverPort, queuePrefix, index)
+                             for index in range(args.queues)
+                             if (queuePrefix + '%04d' % index).startswith(prefix))
+        elif action == 'GetQueueAttributes':
+            wanted = [value for name, value in params.items() if name.startswith('AttributeName')]
+            result = ''.join('<Attribute><Name>%s</Name><Value>%d</Value></Attribute>' % (name, value)
+                             for name, value in queueAttributes(path.rsplit('/', 1)[-1])
+                             if 'All' in wanted or name in wanted)
+        else:
+            self.send_error(400)
+            return
+        response = '<%sResponse xmlns="%s"><%sResult>%s</%sResult><ResponseMetadata>' \
+                   '<RequestId>benchmark</RequestId></ResponseMetadata></%sResponse>' \
+                   % (action, sqsNamespace, action, result, action, action)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *logArgs):
+        pass
+
+
+class MockSQSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+server = MockSQSServer(('127.0.0.1', 0), MockSQSHandler)
+serverHost, serverPort = server.server_address
+serverProcess = multiprocessing.Process(target=server.serve_forever)
+serverProcess.daemon = True
+serverProcess.start()
+server.socket.close()
+
+# Every connection boto makes, in the serial loop
+# and in the check's worker threads, goes to the
+# mock endpoint.
+def connectToMock(region, **connectArgs):
+    return SQSConnection(aws_access_key_id='benchmark', aws_secret_access_key='benchmark',
+                         is_secure=False, port=serverPort,
+                         region=RegionInfo(name=region, endpoint=serverHost))
+
+boto.sqs.connect_to_region = connectToMock
+
+
+##################################################
+# Each case returns the visible depth of each queue
+# by name. serial is the loop the check used before,
+# one ApproximateNumberOfMessages call per queue. The
+# check reads all three counts in one call per queue.
+def serialDepths():
+    conn = boto.sqs.connect_to_region('us-east-1')
+    depths = {}
+    for queue in conn.get_all_queues(prefix=queuePrefix):
+        depths[queue.name] = queue.count()
+    return depths
+
+def checkDepths():
+    result = check.main(['--name', queuePrefix, '--warn', '1000', '--crit', '2000',
+                         '--threads', str(args.threads)])
+    return dict((name, int(depth)) for name, depth
+                in re.findall(r'(' + queuePrefix + r'\d+)=(\d+);', result.perfdata))
+
+benchmarkCases = [
+    ['serial', serialDepths],
+    ['pooled', checkDepths],
+]
+
+caseTimes = {}
+caseDepths = {}
+try:
+    for name, caseFunction in benchmarkCases:
+        for run in range(args.runs):
+            cpuStart = sum(os.times()[0:2])
+            start = time.time()
+            caseDepths[name] = caseFunction()
+            wallTime = time.time() - start
+            cpuTime = sum(os.times()[0:2]) - cpuStart
+            if args.debug:
+                print '%s: %.2fs wall, %.2fs cpu' % (name, wallTime, cpuTime)
+            if name not in caseTimes or wallTime < caseTimes[name][0]:
+                caseTimes[name] = (wallTime, cpuTime)
+finally:
+    serverProcess.terminate()
+
+expectedDepths = dict((queuePrefix + '%04d' % index,
+                       queueAttributes(queuePrefix + '%04d' % index)[0][1])
+                      for index in range(args.queues))
+speedup = caseTimes['serial'][0] / caseTimes['pooled'][0]
+
+caseLines = []
+perfdataMsg = ''
+mismatched = []
+for name, caseFunction in benchmarkCases:
+    wallTime, cpuTime = caseTimes[name]
+    if caseDepths[name] != expectedDepths:
+        mismatched.append(name)
+    caseLines.append('%s: %.2fs wall, %.2fs cpu - %d queues, %d messages'
+                     % (name, wallTime, cpuTime, len(caseDepths[name]),
+                        sum(caseDepths[name].values())))
+    perfdataMsg += '%s=%.3fs;;;0; ' % (name, wallTime)
+perfdataMsg += 'speedup=%.2f;%g;;0; ' % (speedup, args.minspeedup)
+
+if mismatched:
+    exitCode = 2
+    statusMsg = 'CRITICAL - wrong depths reading ' + str(args.queues) + ' queues: ' \
+                + ', '.join(mismatched)
+elif speedup < args.minspeedup:
+    exitCode = 1
+    statusMsg = 'WARNING - pooled reads only %.1fx faster than serial' % speedup
+else:
+    exitCode = 0
+    statusMsg = 'OK - pooled reads of %d queues %.1fx faster than serial, depths match' \
+                % (args.queues, speedup)
+
+print statusMsg + '|' + perfdataMsg
+print '\n'.join(caseLines)
+exit(exitCode)
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Written by Matthew McMillan
+# matthew.mcmillan@gmail.com
+# @matthewmcmillan
+# https://matthewcmcmillan.blogspot.com
+# https://github.com/matt448/nagios-checks
+#
+#
+# This script measures the cold start wall time of each check in this
+# repo so a startup budget can be held for each one. Every case runs
+# the check in a new python process with --help or with arguments that
+# fail validation, so no servers are needed and nothing past argument
+# checking runs. Each case is run --runs times and the best time is
+# compared against its budget. Budgets are milliseconds on top of the
+# startup time of a bare python interpreter, which is measured the same
+# way in the same run, so they mostly hold on faster or slower machines
+# and on a busy one.
+#
+# Output is in Nagios format with one line per case after the first, so
+# it can be run by hand, from cron or as a check. It exits CRITICAL when
+# any case is over budget. Budgets can be scaled with --scale for slower
+# machines.
+#
+
+import sys
+import os
+import time
+import argparse
+import subprocess
+
+def printUsage():
+    print
+    print "Example:    ", sys.argv[0], "--runs 10 --scale 1.5"
+    print
+
+#Parse command line arguments
+parser = argparse.ArgumentParser(description='This script measures the startup time of \
+                                    the checks in this repo against a budget for each.')
+
+parser.add_argument('--runs', dest='runs', type=int, default=10,
+                        help='Times to run each case. The best time is used. Default is 10.')
+
+parser.add_argument('--scale', dest='scale', type=float, default=1,
+                        help='Multiply every budget by this much. Default is 1.')
+
+parser.add_argument('--python', dest='python', type=str, default=sys.executable,
+                        help='Python interpreter to run the checks with. Default is \
+                              the one running this script.')
+
+parser.add_argument('--case', dest='cases', type=str, action='append', default=[],
+                        help='Only run cases whose name contains this. Can be given \
+                              more than once.')
+
+parser.add_argument('--debug', action='store_true', help='Enable debug output.')
+
+args = parser.parse_args()
+
+if args.runs < 1 or args.scale <= 0:
+    print
+    print "ERROR: --runs must be at least 1 and --scale more than 0."
+    printUsage()
+    exit(2)
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+##################################################
+# Each case is a name, the script, its arguments and
+# the startup budget in milliseconds over a bare
+# interpreter. The budgets leave about 15ms over the
+# slowest best times seen on a busy server. The S3
+# and SQS cases go over budget if boto is imported
+# at startup again. Lower them as startup gets faster.
+startupCases = [
+    ['s3_help', 'check_s3_file_age.py', ['--help'], 70],
+    ['sqs_help', 'check_sqs_depth.py', ['--help'], 55],
+    ['sqs_badlevels', 'check_sqs_depth.py', ['--name', 'q', '--warn', '20', '--crit', '10'], 45],
+    ['mysql_help', 'check_mysql_slave_lag.py', ['--help'], 50],
+    ['mysql_badlevels', 'check_mysql_slave_lag.py', ['--user', 'u', '--warn', '20', '--crit', '10'], 50],
+    ['rabbitmq_cluster_help', 'check_rabbitmq_cluster.py', ['--help'], 45],
+    ['rabbitmq_queues_help', 'check_rabbitmq_queues.py', ['--help'], 45],
+    ['json_help', 'check-template-json-webservice.py', ['--help'], 60],
+    ['runner_help', 'check_runner.py', ['--help'], 50],
+]
+
+if args.cases:
+    startupCases = [case for case in startupCases
+                    if any(pattern in case[0] for pattern in args.cases)]
+    if not startupCases:
+        print "ERROR: No cases match " + ", ".join(args.cases)
+        exit(2)
+
+
+# Run a command once and return its wall time in
+# milliseconds. The exit code isn't checked as the
+# cases are meant to fail argument validation.
+def timeRun(cmd):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        return (time.time() - start) * 1000
+
+# Sorted times of --runs runs of a command. The first
+# run warms the disk cache and isn't counted.
+def timeRuns(cmd):
+    timeRun(cmd)
+    return sorted(timeRun(cmd) for run in range(args.runs))
+
+interpreterTimes = timeRuns([args.python, '-c', 'pass'])
+interpreterBest = interpreterTimes[0]
+if args.debug:
+    print 'interpreter: ' + ' '.join('%.1f' % t for t in interpreterTimes)
+
+overCount = 0
+caseLines = []
+perfdataMsg = "interpreter=%.1fms;;;0; " % interpreterBest
+for name, script, scriptArgs, budget in startupCases:
+    budget = interpreterBest + budget * args.scale
+    times = timeRuns([args.python, os.path.join(scriptDir, script)] + scriptArgs)
+    best = times[0]
+    if args.debug:
+        print name + ': ' + ' '.join('%.1f' % t for t in times)
+    if best > budget:
+        overCount += 1
+        state = 'OVER'
+    else:
+        state = 'ok'
+    caseLines.append('%s: %.1fms (budget %.0fms, median %.1fms) %s'
+                     % (name, best, budget, times[len(times) // 2], state))
+    perfdataMsg += '%s=%.1fms;;%.0f;0; ' % (name, best, budget)
+
+if overCount:
+    exitCode = 2
+    statusMsg = 'CRITICAL - ' + str(overCount) + ' of ' + str(len(startupCases)) + ' checks over startup budget'
+else:
+    exitCode = 0
+    statusMsg = 'OK - ' + str(len(startupCases)) + ' checks within startup budget'
+statusMsg += ' (interpreter %.1fms)' % interpreterBest
+
+print statusMsg + '|' + perfdataMsg
+print '\n'.join(caseLines)
+exit(exitCode)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+##########################################################
+#
+# Tests for the heartbeat table mode of check_mysql_slave_lag.py.
+# main() is run in-process against a fake MySQLdb module that serves
+# pt-heartbeat rows, with the clock frozen so the lag is exact.
+#
+# Run with: python -m unittest test_check_mysql_slave_lag
+#
+
+import sys
+import types
+import datetime
+import unittest
+
+import check_mysql_slave_lag
+
+
+# The check reads the clock with datetime.datetime.now() (or utcnow()
+# with --heartbeatutc). Both are frozen 12:34:58.5 on 2017-01-07, UTC is
+# one hour behind.
+class FrozenDatetime(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2017, 1, 7, 12, 34, 58, 500000)
+
+    @classmethod
+    def utcnow(cls):
+        return cls(2017, 1, 7, 11, 34, 58, 500000)
+
+frozenDatetimeModule = types.ModuleType('datetime')
+frozenDatetimeModule.datetime = FrozenDatetime
+frozenDatetimeModule.timedelta = datetime.timedelta
+
+
+# Fake MySQLdb. Each host has a list of [server_id, ts] heartbeat rows
+# and every query is recorded with its parameters.
+class FakeCursor(object):
+    def __init__(self, server):
+        self.server = server
+        self.row = None
+
+    def execute(self, query, params=None):
+        self.server.queries.append((query, params))
+        rows = self.server.heartbeats.get(self.server.host, [])
+        if params is not None:
+            rows = [row for row in rows if row[0] == params[0]]
+        rows = sorted(rows, key=lambda row: str(row[1]), reverse=True)
+        self.row = None
+        if rows:
+            self.row = (rows[0][1],)
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self):
+        return FakeCursor(self.server)
+
+    def close(self):
+        pass
+
+
+class FakeServer(object):
+    def __init__(self, heartbeats, queries, host):
+        self.heartbeats = heartbeats
+        self.queries = queries
+        self.host = host
+
+
+class HeartbeatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.heartbeats = {}
+        self.queries = []
+        fakeMySQLdb = types.ModuleType('MySQLdb')
+        fakeMySQLdb.connect = lambda host=None, **connectArgs: \
+            FakeConnection(FakeServer(self.heartbeats, self.queries, host))
+        self.savedMySQLdb = sys.modules.get('MySQLdb')
+        sys.modules['MySQLdb'] = fakeMySQLdb
+        self.savedDatetime = check_mysql_slave_lag.datetime
+        check_mysql_slave_lag.datetime = frozenDatetimeModule
+
+    def tearDown(self):
+        check_mysql_slave_lag.datetime = self.savedDatetime
+        if self.savedMySQLdb is None:
+            del sys.modules['MySQLdb']
+        else:
+            sys.modules['MySQLdb'] = self.savedMySQLdb
+
+    def runCheck(self, *extraArgs):
+        return check_mysql_slave_lag.main(['--host', 'db01', '--user', 'u', '--pass', 'p',
+                                           '--heartbeattable', 'percona.heartbeat',
+                                           '--warn', '10', '--crit', '20'] + list(extraArgs))
+
+    def test_fractional_seconds(self):
+        self.heartbeats['db01'] = [[1, '2017-01-07T12:34:56.250000']]
+        result = self.runCheck()
+        self.assertEqual(result.state, 0)
+        self.assertEqual(result.message, 'OK - Replication Lag 2.250 seconds')
+        self.assertEqual(result.perfdata, 'lag_ms=2250ms;10000;20000; ')
+        self.assertEqual(self.queries, [('SELECT ts FROM `percona`.`heartbeat` ORDER BY ts DESC LIMIT 1', None)])
+
+    def test_whole_seconds(self):
+        # MySQLdb returns DATETIME columns without fractions as datetime objects
+        self.heartbeats['db01'] = [[1, datetime.datetime(2017, 1, 7, 12, 34, 46)]]
+        result = self.runCheck()
+        self.assertEqual(result.state, 1)
+        self.assertEqual(result.message, 'WARNING - Replication Lag 12.500 seconds')
+        self.assertEqual(result.perfdata, 'lag_ms=12500ms;10000;20000; ')
+
+        self.heartbeats['db01'] = [[1, '2017-01-07 12:34:38']]
+        result = self.runCheck()
+        self.assertEqual(result.state, 2)
+        self.assertEqual(result.message, 'CRITICAL - Replication Lag 20.500 seconds')
+        self.assertEqual(result.perfdata, 'lag_ms=20500ms;10000;20000; ')
+
+    def test_utc(self):
+        self.heartbeats['db01'] = [[1, '2017-01-07T11:34:57.000000']]
+        result = self.runCheck('--heartbeatutc')
+        self.assertEqual(result.message, 'OK - Replication Lag 1.500 seconds')
+
+    def test_serverid(self):
+        self.heartbeats['db01'] = [[1, '2017-01-07T12:34:58.000000'],
+                                   [2, '2017-01-07T12:34:55.000000']]
+        result = self.runCheck('--serverid', '2')
+        self.assertEqual(result.message, 'OK - Replication Lag 3.500 seconds')
+        self.assertEqual(self.queries, [('SELECT ts FROM `percona`.`heartbeat` WHERE server_id = %s '
+                                         'ORDER BY ts DESC LIMIT 1', (2,))])
+
+        # Without --serverid the newest row is used
+        result = self.runCheck()
+        self.assertEqual(result.message, 'OK - Replication Lag 0.500 seconds')
+
+    def test_missing_row(self):
+        self.heartbeats['db01'] = [[1, '2017-01-07T12:34:58.000000']]
+        result = self.runCheck('--serverid', '3')
+        self.assertEqual(result.state, 2)
+        self.assertEqual(result.message, 'CRITICAL - Replication Failed (no heartbeat)')
+        self.assertEqual(result.perfdata, 'lag_ms=0ms;10000;20000; ')
+
+    def test_lag_ms_scaling(self):
+        # Lag is rounded to the nearest millisecond and the levels are
+        # scaled from seconds. A heartbeat ahead of the clock is no lag.
+        self.heartbeats['db01'] = [[1, '2017-01-07T12:34:58.498765']]
+        self.heartbeats['db02'] = [[1, '2017-01-07T12:34:38.499400']]
+        self.heartbeats['db03'] = [[1, '2017-01-07T12:34:59.000000']]
+        result = check_mysql_slave_lag.main(['--hosts', 'db01,db02,db03', '--user', 'u',
+                                             '--pass', 'p', '--heartbeattable', 'heartbeat',
+                                             '--warn', '10', '--crit', '20'])
+        self.assertEqual(result.state, 2)
+        self.assertEqual(result.message, 'CRITICAL - Replication Lag ( db01:0.001s db02:20.001s '
+                                         'db03:0.000s ) [W:10 C:20]')
+        self.assertEqual(result.perfdata, 'db01_lag_ms=1ms;10000;20000; '
+                                          'db02_lag_ms=20001ms;10000;20000; '
+                                          'db03_lag_ms=0ms;10000;20000; ')
+
+
+if __name__ == '__main__':
+    unittest.main()